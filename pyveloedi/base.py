@@ -20,12 +20,95 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
 import decimal
+import httplib
+import itertools
 from lxml import etree
+from multiprocessing.pool import ThreadPool
 import re
+import socket
 import sys
+import threading
 import urllib2
 
+from .metrics import Metrics
+from . import scheduler
+from . import tuning
+
+
+# Errors of the connection to a supplier.
+TRANSPORT_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+_CENTS_EXP = re.compile(r'^\s*([+-]?)(\d*)(?:[.,](\d*))?\s*$')
+
+
+def to_cents(text):
+    # Parses amounts like '12,50' or '-3.1' into an integer of hundredths,
+    # rounding half up.
+    match = _CENTS_EXP.match(text)
+    # Blank amounts are left to Decimal, which rejects them.
+    if match is None or not (match.group(2) or match.group(3)):
+        value = decimal.Decimal(text.replace(',', '.')).quantize(
+            decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+        return int(value.scaleb(2))
+
+    sign, whole, frac = match.groups()
+    frac = frac or ''
+    res = int(whole or '0') * 100 + int((frac + '00')[:2])
+    if frac[2:3] >= '5':
+        res += 1
+    return -res if sign == '-' else res
+
+
+def chunks(iterable, size):
+    # size may be a callable returning the size of the next chunk.
+    it = iter(iterable)
+    while True:
+        n = size() if callable(size) else size
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parallel(func, items, concurrency):
+    # map() with up to concurrency threads.
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return map(func, items)
+    func = scheduler.bound(func)
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def order_lines(lines):
+    # Order lines are (product, quantity) or (code, quantity, unit)
+    # tuples, the latter don't need a product. Yields the latter.
+    for line in lines:
+        if len(line) == 3:
+            yield line
+        else:
+            product, qty = line
+            yield product.code, qty, getattr(product, 'unit_code', None)
+
+
+def merge_lines(lines):
+    # Sums up the quantities of order lines per code.
+    res = collections.OrderedDict()
+    for code, qty, unit in order_lines(lines):
+        if code in res:
+            res[code][1] += qty
+        else:
+            res[code] = [code, qty, unit]
+    return [tuple(line) for line in res.itervalues()]
+
+
+Availability = collections.namedtuple('Availability', 'quantity state')
+
 
 class Field(object):
     def __init__(self, *args, **kwargs):
@@ -33,12 +116,18 @@ class Field(object):
         self._args = args
         self._kwargs = kwargs
 
-    def parse(self, rec):
+    def find(self, rec):
         for prefix in [''] + rec._prefixes:
             for path in self._args:
                 node = rec._data.find(prefix + path, namespaces=rec._namespaces)
                 if node is not None:
-                    return self._convert(node)
+                    return node
+        return None
+
+    def parse(self, rec):
+        node = self.find(rec)
+        if node is not None:
+            return self._convert(node)
 
         return self._default
 
@@ -80,8 +169,7 @@ class Integer(Field):
 
 class Decimal(Field):
     def _convert(self, node):
-        return decimal.Decimal('%.2f' % decimal.Decimal(
-                node.text.replace(',', '.')))
+        return decimal.Decimal(to_cents(node.text)).scaleb(-2)
 
 
 class URL(Field):
@@ -179,10 +267,107 @@ class ProductBase(Model):
     def availability(self):
         return None
 
+    @classmethod
+    def _indexed(cls, products):
+        # Adds read products to the index of the context.
+        if cls._ctx.index is not None:
+            cls._ctx.index.add(products)
+        return products
+
+    @classmethod
+    def _local_index(cls):
+        # The index of the context if it can answer searches.
+        index = cls._ctx.index
+        if index is not None and index.complete:
+            return index
+        return None
+
+    @classmethod
+    def search(cls, keywords, offset=0, limit=20, count=False):
+        # Answered by the local index or the search cache if possible.
+        index = cls._local_index()
+        if index is not None:
+            return index.search(keywords, offset, limit, count)
+        cache = cls._ctx.search_cache
+        if cache is not None:
+            return cache.search(cls._ctx, cls._search, keywords, offset,
+                                limit, count)
+        return cls._search(keywords, offset, limit, count)
+
+    @classmethod
+    def _search(cls, keywords, offset=0, limit=20, count=False):
+        # The supplier's search.
+        raise NotImplementedError()
+
+    @classmethod
+    def iter_search(cls, keywords, offset=0, page_size=100, fresh=False):
+        # Yields the codes of all matching records page by page. With fresh
+        # no search results cached by the supplier connection are reused.
+        raise NotImplementedError()
+
+    @classmethod
+    def _batch_size(cls, batch_size):
+        # The tuned batch size of the supplier unless one is given.
+        return batch_size or cls._ctx.batch_tuner.size
+
+    @classmethod
+    def iter_read(cls, codes, batch_size=None):
+        # Reads any iterable of codes in batches and yields the products.
+        for batch in chunks(codes, cls._batch_size(batch_size)):
+            for product in cls.read(batch):
+                yield product
+
+    @classmethod
+    def search_products(cls, keywords, offset=0, limit=None, page_size=100,
+                        concurrency=4):
+        # Yields the products of a search instead of their codes.
+        page_size = page_size or cls._ctx.batch_tuner.size()
+        codes = cls.iter_search(keywords, offset, page_size)
+        if limit is not None:
+            codes = itertools.islice(codes, limit)
+        return cls.iter_read(codes, page_size)
+
+
+class LineBase(Model):
+    product = Field()
+    quantity = Field()
+    unit_price = Field()
+    availability = Field()
+    available_quantity = Field()
+
 
 class OrderBase(Model):
     orderid = Field()
-    lines = Field()
+
+    def iter_lines(self):
+        # Streams the lines of the order, nothing is kept.
+        raise NotImplementedError()
+
+    @property
+    def lines(self):
+        # Wrapped once per response.
+        cached = self.__dict__.get('_lines_cache')
+        if cached is None or cached[0] is not self._data:
+            cached = self._lines_cache = (self._data, list(self.iter_lines()))
+        return cached[1]
+
+    @classmethod
+    def check_availability(cls, lines, chunk_size=100, concurrency=4):
+        # Checks order lines with one test order per chunk, which is
+        # discarded afterwards. Returns {code: Availability}.
+        res = {}
+        for result in parallel(cls._check_chunk,
+                               chunks(merge_lines(lines), chunk_size),
+                               concurrency):
+            res.update((line.product.code, Availability(
+                            line.available_quantity, line.availability))
+                       for line in result)
+        return res
+
+    @classmethod
+    def _check_chunk(cls, lines):
+        # Returns the lines of a discarded test order of the lines.
+        raise NotImplementedError()
 
 
 class EDIException(Exception):
@@ -198,12 +383,29 @@ class EDIException(Exception):
         return repr(self._msg)
 
 
+class UnavailableException(EDIException):
+    def __init__(self, url):
+        self._code = 0
+        self._msg = 'Supplier is down: %s' % url
+
+
 class ContextBase(object):
     def __init__(self, url, userid, passwd, log=False):
         self._url = url
         self._userid = userid
         self._passwd = passwd
         self._log = log
+        self._models = {}
+        self._models_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.scheduler = scheduler.for_url(url)
+        self.batch_tuner = tuning.for_url(url)
+        # Set by health.HealthMonitor.register
+        self.health = None
+        self.breaker = None
+        # Optional index.ProductIndex and searchcache.SearchCache
+        self.index = None
+        self.search_cache = None
 
     def log(self, info, msg):
         if self._log:
@@ -214,6 +416,14 @@ class ContextBase(object):
             print '[ @%s%s (%s) ]' % (cls, frame.f_code.co_name, info)
             print msg + '\n'
 
+    def _bind(self, model):
+        # One bound model class per context, they are created only once.
+        with self._models_lock:
+            Class = self._models.get(model)
+            if Class is None:
+                Class = self._models[model] = model.copy(self)
+            return Class
+
     def get(self, clsname):
         raise NotImplementedError()
 
@@ -223,5 +433,23 @@ class ContextBase(object):
     def get_product(self, code):
         raise NotImplementedError()
 
-    def check(self):
+    def check_breaker(self):
+        # Called before every request.
+        if self.breaker is not None and not self.breaker.allow():
+            raise UnavailableException(self._url)
+
+    def probe(self):
+        # A cheap request which fails if the supplier can't be used.
         raise NotImplementedError()
+
+    def check(self):
+        # Answered from the health monitor if the context is registered.
+        if self.health is not None:
+            status = self.health.status(self)
+            if status is not None:
+                return status.ok
+        try:
+            self.probe()
+        except:
+            return False
+        return True
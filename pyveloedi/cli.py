@@ -0,0 +1,371 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Command line tool for bulk reads and searches.
+#
+# Contexts are configured in an ini file, one section per supplier:
+#
+#   [boettcher]
+#   type = veloconnect
+#   url = http://boettcher.veloconnect.de
+#   userid = ...
+#   passwd = ...
+#
+#   pyveloedi read codes.txt --format csv > prices.csv
+#   pyveloedi search glocke --limit 100 --context boettcher
+
+import ConfigParser
+import anydbm
+import argparse
+import collections
+import csv
+import itertools
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from . import serialize
+from . import tuning
+from .base import chunks, parallel
+from .veloconnect import Context as VeloContext
+from .winora import Context as WinoraContext
+
+CONTEXTS = {
+    'veloconnect': VeloContext,
+    'winora': WinoraContext,
+}
+
+COLUMNS = ['context', 'code', 'valid', 'ean13', 'name', 'manufacturer',
+           'list_price', 'cost_price', 'unit_code', 'availability',
+           'available_quantity', 'replacement']
+
+DEFAULT_CONFIG = os.path.expanduser('~/.pyveloedi.ini')
+
+# Search results checked for the EAN of a --ean lookup.
+EAN_CANDIDATES = 5
+
+
+def load_contexts(path, names):
+    config = ConfigParser.SafeConfigParser()
+    if not config.read(path):
+        raise SystemExit('Can\'t read configuration %s' % path)
+
+    res = collections.OrderedDict()
+    for name in names or config.sections():
+        if not config.has_section(name):
+            raise SystemExit('Unknown context %s' % name)
+        get = lambda option, default=None: (
+            config.get(name, option) if config.has_option(name, option)
+            else default)
+        kind = get('type', 'veloconnect')
+        if kind not in CONTEXTS:
+            raise SystemExit('Unknown type %s for context %s' % (kind, name))
+        kwargs = dict(url=get('url'), userid=get('userid'),
+                      passwd=get('passwd'))
+        if kind == 'veloconnect':
+            kwargs['istest'] = get('istest', 'false').lower() in (
+                '1', 'true', 'yes', 'on')
+        res[name] = CONTEXTS[kind](**kwargs)
+    return res
+
+
+class Cache(object):
+    # Product records per context and code, stored in the serialize format
+    # behind a timestamp.
+    _STAMP = struct.Struct('<d')
+
+    def __init__(self, path, ttl):
+        self._db = anydbm.open(path, 'c')
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+    def _key(self, context, code):
+        return ('%s\0%s' % (context, code)).encode('utf-8')
+
+    def get(self, context, code):
+        # gdbm objects have no get().
+        try:
+            with self._lock:
+                value = self._db[self._key(context, code)]
+        except KeyError:
+            return None
+        stamp, = self._STAMP.unpack(value[:self._STAMP.size])
+        if time.time() - stamp > self._ttl:
+            return None
+        return serialize.unpack(value[self._STAMP.size:])
+
+    def set(self, context, code, record):
+        value = self._STAMP.pack(time.time()) + serialize.pack(record)
+        with self._lock:
+            self._db[self._key(context, code)] = value
+
+    def close(self):
+        self._db.close()
+
+
+class Stats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.records = 0
+        self.cached = 0
+        self.errors = 0
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return ('%d records (%d from cache, %d errors) in %.1fs, '
+                '%.1f records/s' % (self.records, self.cached, self.errors,
+                                    elapsed, self.records / elapsed))
+
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return value
+    return unicode(value)
+
+
+def row(context, record):
+    res = collections.OrderedDict([('context', context)])
+    for name in COLUMNS[1:]:
+        res[name] = _text(getattr(record, name, None))
+    return res
+
+
+class NDJSONWriter(object):
+    def __init__(self, out):
+        self._out = out
+
+    def write(self, row):
+        self._out.write(json.dumps(row) + '\n')
+
+
+class CSVWriter(object):
+    def __init__(self, out):
+        self._writer = csv.writer(out)
+        self._writer.writerow(COLUMNS)
+
+    def write(self, row):
+        self._writer.writerow([
+            (u'' if v is None else unicode(v)).encode('utf-8')
+            for v in row.values()])
+
+
+WRITERS = {
+    'ndjson': NDJSONWriter,
+    'csv': CSVWriter,
+}
+
+
+def find_eans(Product, eans, concurrency):
+    # The EANs are searched concurrently and the found codes read at once.
+    # Only products with the searched EAN count, not any text match.
+    found = parallel(lambda ean: Product.search([ean], 0, EAN_CANDIDATES),
+                     eans, concurrency)
+    codes = set(itertools.chain.from_iterable(found))
+    wanted = set(eans)
+    res = {}
+    for product in Product.iter_read(list(codes)):
+        if product.ean13 in wanted:
+            res.setdefault(product.ean13, product)
+    return res
+
+
+def read_batch(args, name, context, batch, cache):
+    # Returns the records in input order and the number of cache hits.
+    Product = context.get('Product')
+    res = {}
+    missing = []
+    for code in batch:
+        record = cache.get(name, code) if cache is not None else None
+        if record is None:
+            missing.append(code)
+        else:
+            res[code] = record
+
+    if missing:
+        if args.ean:
+            found = find_eans(Product, missing, args.concurrency)
+            for ean in missing:
+                if ean in found:
+                    res[ean] = serialize.to_record(found[ean])
+                else:
+                    sys.stderr.write('%s: no product with EAN %s\n'
+                                     % (name, ean))
+        else:
+            for product in Product.read(missing):
+                res[product.code] = serialize.to_record(product)
+        if cache is not None:
+            for code in missing:
+                if code in res:
+                    cache.set(name, code, res[code])
+
+    return ([res[code] for code in batch if code in res],
+            len(batch) - len(missing))
+
+
+def run_window(tasks, concurrency, emit, stats):
+    # Runs (label, func, args) tasks with bounded look ahead and emits the
+    # results in order.
+    pool = ThreadPool(concurrency)
+    pending = collections.deque()
+
+    def flush(block):
+        while pending and (block or pending[0][1].ready()):
+            label, result = pending.popleft()
+            try:
+                emit(label, result.get())
+            except Exception, e:
+                stats.errors += 1
+                sys.stderr.write('%s: %s\n' % (label, e))
+
+    try:
+        for label, func, args in tasks:
+            pending.append((label, pool.apply_async(func, args)))
+            flush(False)
+            if len(pending) >= 2 * concurrency:
+                pending[0][1].wait()
+                flush(False)
+        flush(True)
+    finally:
+        pool.terminate()
+
+
+def iter_codes(path):
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            code = line.strip().decode('utf-8')
+            if code and not code.startswith('#'):
+                yield code
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def cmd_read(args, contexts, writer, cache, stats):
+    # Without --batch-size the smallest tuned size of the suppliers.
+    batch_size = args.batch_size or (lambda: min(
+        context.batch_tuner.size() for context in contexts.itervalues()))
+
+    def tasks():
+        for batch in chunks(iter_codes(args.input), batch_size):
+            for name, context in contexts.iteritems():
+                yield (name, read_batch, (args, name, context, batch, cache))
+
+    def emit(name, result):
+        records, cached = result
+        stats.cached += cached
+        for record in records:
+            writer.write(row(name, record))
+            stats.records += 1
+
+    run_window(tasks(), args.concurrency, emit, stats)
+
+
+def cmd_search(args, contexts, writer, cache, stats):
+    def search(context):
+        Product = context.get('Product')
+        return Product.search_products(
+            args.keywords, args.offset, args.limit, args.batch_size,
+            args.concurrency)
+
+    for name, context in contexts.iteritems():
+        try:
+            for product in search(context):
+                record = serialize.to_record(product)
+                if cache is not None:
+                    cache.set(name, record.code, record)
+                writer.write(row(name, record))
+                stats.records += 1
+        except Exception, e:
+            stats.errors += 1
+            sys.stderr.write('%s: %s\n' % (name, e))
+
+
+def parser():
+    # The options are given after the command, e.g. read --format csv.
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default=DEFAULT_CONFIG,
+                        help='ini file with one section per context')
+    common.add_argument('--context', action='append', dest='contexts',
+                        help='context to use, may be repeated (default: all)')
+    common.add_argument('--format', choices=sorted(WRITERS), default='ndjson')
+    common.add_argument('--concurrency', type=int, default=4)
+    common.add_argument('--batch-size', type=int,
+                        help='codes per request (default: tuned per supplier)')
+    common.add_argument('--tuning',
+                        help='JSON file keeping the tuned batch sizes')
+    common.add_argument('--cache', help='dbm file caching product records')
+    common.add_argument('--cache-ttl', type=int, default=3600,
+                        help='seconds a cached record is valid')
+    common.add_argument('--quiet', action='store_true',
+                        help='don\'t print the summary')
+
+    res = argparse.ArgumentParser(
+        prog='pyveloedi',
+        description='Bulk product reads and searches.')
+    sub = res.add_subparsers(dest='command')
+
+    read = sub.add_parser('read', parents=[common],
+                          help='read codes from a file or stdin')
+    read.add_argument('input', nargs='?', default='-')
+    read.add_argument('--ean', action='store_true',
+                      help='input contains EANs instead of codes')
+    read.set_defaults(func=cmd_read)
+
+    search = sub.add_parser('search', parents=[common],
+                            help='search products')
+    search.add_argument('keywords', nargs='+')
+    search.add_argument('--offset', type=int, default=0)
+    search.add_argument('--limit', type=int)
+    search.set_defaults(func=cmd_search)
+    return res
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.tuning:
+        tuning.persist(args.tuning)
+    contexts = load_contexts(args.config, args.contexts)
+    cache = Cache(args.cache, args.cache_ttl) if args.cache else None
+    writer = WRITERS[args.format](sys.stdout)
+    stats = Stats()
+    try:
+        args.func(args, contexts, writer, cache, stats)
+    finally:
+        for context in contexts.itervalues():
+            if hasattr(context, 'close'):
+                context.close()
+        if cache is not None:
+            cache.close()
+        if not args.quiet:
+            sys.stderr.write(stats.summary() + '\n')
+    return 1 if stats.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Columnar export of prices and availability for analytics. Needs numpy.
+#
+# Amounts are stored as int64 hundredths (MISSING where a product has no
+# value) with float64 columns (NaN where missing) next to them. Availability
+# codes and manufacturers are exported as categoricals.
+#
+#   columns = export(Product.iter_read(codes))
+#   margin = columns.list_price - columns.cost_price
+
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .base import Field, to_cents
+
+MISSING = -2 ** 63
+
+AMOUNTS = ('list_price', 'cost_price', 'available_quantity')
+CATEGORIES = ('availability', 'manufacturer')
+
+Categorical = collections.namedtuple('Categorical', 'categories codes')
+
+
+def amount_cents(product, name):
+    # Read the text of model fields directly, skipping the Decimal.
+    field = getattr(type(product), name, None)
+    data = getattr(product, '_data', None)
+    if isinstance(field, Field) and data is not None:
+        node = field.find(product)
+        if node is None or node.text is None:
+            return MISSING
+        return to_cents(node.text)
+
+    value = getattr(product, name, None)
+    if value is None:
+        return MISSING
+    return int(value.scaleb(2))
+
+
+def _categorical(values):
+    categories = {}
+    codes = []
+    for value in values:
+        if value is None:
+            codes.append(-1)
+        else:
+            codes.append(categories.setdefault(value, len(categories)))
+    names = numpy.empty(len(categories), dtype=object)
+    for value, idx in categories.iteritems():
+        names[idx] = value
+    return Categorical(names, numpy.array(codes, dtype=numpy.int32))
+
+
+class Columns(object):
+    def __init__(self, codes, cents, categories):
+        self.size = len(codes)
+        self.code = numpy.array(codes, dtype=object)
+        for name in AMOUNTS:
+            values = numpy.array(cents[name], dtype=numpy.int64)
+            missing = values == MISSING
+            floats = values / 100.0
+            floats[missing] = numpy.nan
+            setattr(self, name + '_cents', values)
+            setattr(self, name, floats)
+        for name in CATEGORIES:
+            setattr(self, name, _categorical(categories[name]))
+
+    def __len__(self):
+        return self.size
+
+
+def export(products):
+    # Works on any iterable of products or records, e.g. a streaming read.
+    if numpy is None:
+        raise ImportError('numpy is required for the columnar export.')
+
+    codes = []
+    cents = dict((name, []) for name in AMOUNTS)
+    categories = dict((name, []) for name in CATEGORIES)
+    for product in products:
+        codes.append(product.code)
+        for name in AMOUNTS:
+            cents[name].append(amount_cents(product, name))
+        for name in CATEGORIES:
+            categories[name].append(getattr(product, name, None))
+
+    return Columns(codes, cents, categories)
@@ -0,0 +1,210 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Background health monitor for suppliers.
+#
+# Registered contexts are probed concurrently every interval seconds, each
+# in its own thread, so suppliers that hang can't delay the probes of the
+# others. The latest Status is cached, so context.check() answers
+# immediately. Every context gets a CircuitBreaker fed by the probes: after
+# threshold failed probes in a row, requests raise base.UnavailableException
+# instead of waiting for a supplier which is down.
+#
+#   monitor = HealthMonitor(interval=60)
+#   for context in contexts:
+#       monitor.register(context)
+#   monitor.start()
+
+import collections
+import threading
+import time
+
+Status = collections.namedtuple('Status', 'ok latency error checked')
+
+CLOSED = 'closed'
+OPEN = 'open'
+
+# Probes pass the breaker of their context.
+_probing = threading.local()
+
+
+class CircuitBreaker(object):
+    # Opens after threshold failed probes in a row and closes with the next
+    # successful one. Probe results older than stale seconds are ignored,
+    # so requests pass again if the monitor was stopped.
+    def __init__(self, threshold=3, stale=300):
+        self.threshold = threshold
+        self.stale = stale
+        self.state = CLOSED
+        self.failures = 0
+        self.updated = None
+        self._lock = threading.Lock()
+
+    def record(self, ok):
+        with self._lock:
+            self.updated = time.time()
+            if ok:
+                self.failures = 0
+                self.state = CLOSED
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.state = OPEN
+
+    def allow(self):
+        if self.state == CLOSED or getattr(_probing, 'active', False):
+            return True
+        return time.time() - self.updated > self.stale
+
+
+class _Probe(object):
+    # A probe running in its own daemon thread.
+    def __init__(self, func, context):
+        self.started = None
+        self.status = None
+        self.begun = threading.Event()
+        self.done = threading.Event()
+        thread = threading.Thread(target=self._run, args=(func, context))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, func, context):
+        self.started = time.time()
+        self.begun.set()
+        try:
+            self.status = func(context)
+        finally:
+            self.done.set()
+
+
+class HealthMonitor(object):
+    def __init__(self, interval=60, timeout=30, threshold=3):
+        self.interval = interval
+        self.timeout = timeout
+        self.threshold = threshold
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # context -> [status, running probe]
+        self._contexts = {}
+
+    def register(self, context):
+        with self._lock:
+            if context in self._contexts:
+                return
+            self._contexts[context] = [None, None]
+        context.breaker = CircuitBreaker(
+            self.threshold, 3 * self.interval + self.timeout)
+        context.health = self
+
+    def unregister(self, context):
+        with self._lock:
+            if self._contexts.pop(context, None) is None:
+                return
+        context.breaker = None
+        context.health = None
+
+    def status(self, context):
+        # The latest Status or None if the context wasn't probed yet.
+        with self._lock:
+            return self._contexts.get(context, [None])[0]
+
+    def statuses(self):
+        with self._lock:
+            return dict((ctx, state[0])
+                        for ctx, state in self._contexts.iteritems())
+
+    def _probe(self, context):
+        _probing.active = True
+        start = time.time()
+        try:
+            context.probe()
+        except Exception, e:
+            error = getattr(e, 'code', None)
+            if error is None:
+                error = e.__class__.__name__
+            return Status(False, time.time() - start, error, time.time())
+        finally:
+            _probing.active = False
+        return Status(True, time.time() - start, None, time.time())
+
+    def _record(self, context, status):
+        with self._lock:
+            state = self._contexts.get(context)
+            if state is None:
+                return
+            state[0] = status
+        if context.breaker is not None:
+            context.breaker.record(status.ok)
+        context.metrics.gauge('health.ok', int(status.ok))
+        if status.latency is not None:
+            context.metrics.timing('health.latency', status.latency)
+
+    def probe_all(self):
+        # Probes all contexts at once and gives every probe timeout seconds
+        # from its start. Contexts whose probe of an earlier round still
+        # hangs are not probed again and count as failed.
+        started = []
+        hanging = []
+        with self._lock:
+            for ctx, state in self._contexts.iteritems():
+                if state[1] is not None and not state[1].done.is_set():
+                    hanging.append(ctx)
+                    continue
+                state[1] = _Probe(self._probe, ctx)
+                started.append((ctx, state[1]))
+
+        for ctx in hanging:
+            self._record(ctx, Status(False, None, 'timeout', time.time()))
+
+        for ctx, probe in started:
+            if not probe.begun.wait(self.timeout):
+                # Never started, that's not the supplier's fault.
+                continue
+            probe.done.wait(max(probe.started + self.timeout - time.time(),
+                                0))
+            status = probe.status
+            if status is None:
+                status = Status(False, None, 'timeout', time.time())
+            self._record(ctx, status)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            started = time.time()
+            self.probe_all()
+            self._stop.wait(max(self.interval - (time.time() - started), 0))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        # Hanging probes are not waited for, their threads are daemons.
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
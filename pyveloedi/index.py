@@ -0,0 +1,220 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Local full text index of products.
+#
+# Products read by a context with an index are added to it. Every keyword
+# has to match the beginning of a word of the code, EAN, manufacturer, name
+# or description. Matches are ranked by the weight of the fields, exact
+# words rank higher than prefixes. Once the index is marked complete,
+# Product.search is answered locally. The index doesn't know on its own
+# whether it holds the whole catalog, e.g. after a CatalogSync.
+#
+#   context.index = ProductIndex('catalog.idx')
+#   for change in CatalogSync(context, [''], 'catalog.json').run():
+#       pass
+#   context.index.complete = True
+#   Product.search(['glo'])
+
+import bisect
+import collections
+import json
+import os
+import re
+import threading
+
+FIELDS = (
+    ('code', 5),
+    ('ean13', 5),
+    ('manufacturer', 3),
+    ('name', 2),
+    ('description', 1),
+)
+
+_WORD_EXP = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return _WORD_EXP.findall(text.lower()) if text else []
+
+
+class ProductIndex(object):
+    def __init__(self, path=None, autosave=1000):
+        self.path = path
+        self.autosave = autosave
+        self.complete = False
+        self._lock = threading.Lock()
+        # code -> {field: text}
+        self._docs = {}
+        # word -> {code: weight}
+        self._postings = collections.defaultdict(dict)
+        # Sorted words for prefix lookups, None when outdated.
+        self._words = None
+        self._changes = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, code):
+        return code in self._docs
+
+    def _insert(self, code, doc):
+        for field, weight in FIELDS:
+            for word in tokenize(doc.get(field)):
+                postings = self._postings[word]
+                if postings.get(code, 0) < weight:
+                    postings[code] = weight
+        self._docs[code] = doc
+
+    def _delete(self, code):
+        doc = self._docs.pop(code, None)
+        if doc is None:
+            return
+        for field, _ in FIELDS:
+            for word in tokenize(doc.get(field)):
+                postings = self._postings.get(word)
+                if postings is not None:
+                    postings.pop(code, None)
+                    if not postings:
+                        del self._postings[word]
+
+    def _changed(self, count=1):
+        self._words = None
+        self._changes += count
+        if self.path is not None and self._changes >= self.autosave:
+            self._save()
+
+    def add(self, products):
+        # Products and serialize records, invalid ones are skipped.
+        with self._lock:
+            count = 0
+            for product in products:
+                if not getattr(product, 'valid', False) \
+                        or getattr(product, 'replacement', None) is not None:
+                    continue
+                doc = dict((field, getattr(product, field, None))
+                           for field, _ in FIELDS)
+                code = doc['code']
+                if self._docs.get(code) == doc:
+                    continue
+                self._delete(code)
+                self._insert(code, doc)
+                count += 1
+            if count:
+                self._changed(count)
+
+    def remove(self, codes):
+        with self._lock:
+            count = 0
+            for code in codes:
+                if code in self._docs:
+                    self._delete(code)
+                    count += 1
+            if count:
+                self._changed(count)
+
+    def _expand(self, prefix):
+        # Words starting with prefix.
+        if self._words is None:
+            self._words = sorted(self._postings)
+        words = self._words
+        res = []
+        i = bisect.bisect_left(words, prefix)
+        while i < len(words) and words[i].startswith(prefix):
+            res.append(words[i])
+            i += 1
+        return res
+
+    def _match(self, keywords):
+        # {code: score} of the codes matching all keywords. The most
+        # selective keyword goes first, the others only check its codes.
+        terms = []
+        for keyword in tokenize(' '.join(keywords)):
+            words = self._expand(keyword)
+            size = sum(len(self._postings[word]) for word in words)
+            terms.append((size, keyword, words))
+        terms.sort()
+
+        res = None
+        for size, keyword, words in terms:
+            postings = [(self._postings[word], 2 if word == keyword else 1)
+                        for word in words]
+            if res is None:
+                res = {}
+                for codes, exact in postings:
+                    for code, weight in codes.iteritems():
+                        if res.get(code, 0) < weight * exact:
+                            res[code] = weight * exact
+            else:
+                matched = {}
+                for code, score in res.iteritems():
+                    best = max([codes.get(code, 0) * exact
+                                for codes, exact in postings] or [0])
+                    if best:
+                        matched[code] = score + best
+                res = matched
+            if not res:
+                break
+        return res or {}
+
+    def search(self, keywords, offset=0, limit=20, count=False):
+        # Same interface as Product.search, limit may be None.
+        with self._lock:
+            scores = self._match(keywords)
+        if count:
+            return len(scores)
+        ranked = sorted(scores, key=lambda code: (-scores[code], code))
+        end = None if limit is None else offset + limit
+        return ranked[offset:end]
+
+    def suggest(self, prefix, limit=10):
+        # Words starting with prefix, the most frequent first.
+        prefix = prefix.lower()
+        with self._lock:
+            words = [(len(self._postings[w]), w) for w in self._expand(prefix)]
+        words.sort(key=lambda item: (-item[0], item[1]))
+        return [w for _, w in words[:limit]]
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'complete': self.complete, 'docs': self._docs}, f)
+        os.rename(tmp, self.path)
+        self._changes = 0
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def load(self):
+        with open(self.path) as f:
+            state = json.load(f)
+        with self._lock:
+            self._docs = {}
+            self._postings.clear()
+            for code, doc in state['docs'].iteritems():
+                self._insert(code, doc)
+            self.complete = state['complete']
+            self._words = None
+            self._changes = 0
@@ -0,0 +1,110 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Runtime metrics of a context.
+#
+# Counters, gauges and exponentially weighted moving averages are kept per
+# dotted name. Hooks are called as hook(kind, name, value) on every update,
+# e.g. to forward the values to a monitoring system.
+#
+#   context.metrics.add_hook(lambda kind, name, value: statsd.send(...))
+#   context.metrics.snapshot()
+
+import collections
+import threading
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+TIMING = 'timing'
+
+
+class EWMA(object):
+    # Exponentially weighted moving average, value is None until the first
+    # update. Not thread safe on its own.
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.value = None
+        self.count = 0
+
+    def update(self, value):
+        if self.value is None:
+            self.value = float(value)
+        else:
+            self.value += self.alpha * (value - self.value)
+        self.count += 1
+        return self.value
+
+
+class Metrics(object):
+    def __init__(self, alpha=0.2):
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+        self._gauges = {}
+        self._timings = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def _notify(self, kind, name, value):
+        for hook in list(self._hooks):
+            hook(kind, name, value)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+        self._notify(COUNTER, name, value)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+        self._notify(GAUGE, name, value)
+
+    def timing(self, name, seconds):
+        with self._lock:
+            avg = self._timings.get(name)
+            if avg is None:
+                avg = self._timings[name] = EWMA(self._alpha)
+            avg.update(seconds)
+        self._notify(TIMING, name, seconds)
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def average(self, name):
+        with self._lock:
+            avg = self._timings.get(name)
+            return avg.value if avg is not None else None
+
+    def snapshot(self):
+        # Plain dict of all current values, timings as their average.
+        with self._lock:
+            res = dict(self._counters)
+            res.update(self._gauges)
+            res.update((name, avg.value)
+                       for name, avg in self._timings.iteritems())
+            return res
@@ -0,0 +1,176 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Profiling of model field access.
+#
+# While enabled, every access of a field or property of a Model is counted
+# and timed per model class and attribute. Times are cumulative, a property
+# using other fields includes their time. For plain fields the lookups are
+# classified: found by the first path, found by a fallback path or prefix,
+# or the default was returned. Model attribute access is only slower while
+# profiling is enabled.
+#
+#   with profiling.profile() as profiler:
+#       products = Product.read(codes)
+#       [p.name for p in products]
+#   print profiler.report()
+#   profiler.publish(context.metrics)
+
+import contextlib
+import threading
+import time
+
+from . import base
+
+FIRST = 0
+FALLBACK = 1
+DEFAULT = 2
+
+
+def _outcome(field, rec):
+    # How a plain field finds its node, see Field.find.
+    first = True
+    for prefix in [''] + rec._prefixes:
+        for path in field._args:
+            node = rec._data.find(prefix + path, namespaces=rec._namespaces)
+            if node is not None:
+                return FIRST if first else FALLBACK
+            first = False
+    return DEFAULT
+
+
+class Stats(object):
+    __slots__ = ('calls', 'time', 'outcomes')
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.outcomes = [0, 0, 0]
+
+    @property
+    def hit_rate(self):
+        # Share of lookups found by the first path, None for properties
+        # and fields with their own lookup.
+        total = sum(self.outcomes)
+        return float(self.outcomes[FIRST]) / total if total else None
+
+
+class Profiler(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (class name, attribute) -> Stats
+        self._stats = {}
+
+    def _record(self, key, elapsed, outcome):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = Stats()
+            stats.calls += 1
+            stats.time += elapsed
+            if outcome is not None:
+                stats.outcomes[outcome] += 1
+
+    def getattribute(self, rec, name):
+        # Replaces Model.__getattribute__ while enabled.
+        if name[:1] == '_':
+            return object.__getattribute__(rec, name)
+        cls = type(rec)
+        attr = getattr(cls, name, None)
+        if isinstance(attr, base.Field):
+            start = time.time()
+            res = attr.parse(rec)
+            elapsed = time.time() - start
+            outcome = None
+            if type(attr).parse.im_func is base.Field.parse.im_func \
+                    and attr._args:
+                outcome = _outcome(attr, rec)
+            self._record((cls.__name__, name), elapsed, outcome)
+            return res
+        if isinstance(attr, property):
+            start = time.time()
+            try:
+                return object.__getattribute__(rec, name)
+            finally:
+                self._record((cls.__name__, name), time.time() - start, None)
+        return object.__getattribute__(rec, name)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self, sort='time'):
+        # Text table sorted by cumulative time or calls.
+        rows = sorted(self.stats().items(),
+                      key=lambda item: getattr(item[1], sort), reverse=True)
+        lines = ['%-40s %10s %10s %10s %8s %8s %8s' % (
+            'attribute', 'calls', 'total ms', 'per us', 'first', 'fallback',
+            'default')]
+        for (clsname, name), stats in rows:
+            lines.append('%-40s %10d %10.2f %10.2f %8d %8d %8d' % (
+                clsname + '.' + name, stats.calls, stats.time * 1000,
+                stats.time / stats.calls * 1e6, stats.outcomes[FIRST],
+                stats.outcomes[FALLBACK], stats.outcomes[DEFAULT]))
+        return '\n'.join(lines)
+
+    def publish(self, metrics):
+        # Feeds the totals to a metrics.Metrics, e.g. context.metrics.
+        for (clsname, name), stats in self.stats().iteritems():
+            prefix = 'model.%s.%s.' % (clsname, name)
+            metrics.gauge(prefix + 'calls', stats.calls)
+            metrics.gauge(prefix + 'time', stats.time)
+            if stats.hit_rate is not None:
+                metrics.gauge(prefix + 'hit_rate', stats.hit_rate)
+
+
+_original = base.Model.__dict__['__getattribute__']
+_active = None
+
+
+def enable(profiler=None):
+    global _active
+    if profiler is None:
+        profiler = Profiler()
+    _active = profiler
+    base.Model.__getattribute__ = \
+        lambda rec, name: profiler.getattribute(rec, name)
+    return profiler
+
+
+def disable():
+    global _active
+    base.Model.__getattribute__ = _original
+    profiler, _active = _active, None
+    return profiler
+
+
+@contextlib.contextmanager
+def profile(profiler=None):
+    profiler = enable(profiler)
+    try:
+        yield profiler
+    finally:
+        disable()
@@ -0,0 +1,148 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Order routing across suppliers.
+#
+# Lines are (key, quantity) tuples. A key is the supplier's code unless
+# codes maps it per context, e.g. {context: {ean: code}}. All suppliers
+# are asked for prices and availability at once, the availability by
+# test orders or baskets which are discarded. Every line is split among
+# the cheapest suppliers which have it available. Without fixed costs
+# per order this split has the lowest total cost.
+#
+#   plan = plan_order(contexts, [(u'4001234567890', 3)], codes=eans)
+#   print plan.cost, plan.unfilled, plan.errors
+#   orders = plan.execute()
+
+import collections
+import decimal
+
+from .base import parallel
+
+AVAILABLE = 'available'
+
+Quote = collections.namedtuple('Quote', 'context product price quantity')
+
+
+def _available(availability, qty):
+    # Some suppliers only send the state.
+    if availability is None:
+        return 0
+    if availability.quantity is not None:
+        return max(availability.quantity, 0)
+    return qty if availability.state == AVAILABLE else 0
+
+
+def quote(context, lines, codes=None):
+    # [(key, Quote)] of the lines known and available at the supplier.
+    codes = codes or {}
+    by_code = dict((codes.get(key, key), (key, qty)) for key, qty in lines)
+    Product = context.get('Product')
+    Order = context.get('Order')
+    # In batches of the tuned size, baskets may have thousands of lines.
+    products = [p for p in Product.iter_read(list(by_code))
+                if getattr(p, 'valid', False) and p.code in by_code]
+    if not products:
+        return []
+
+    availability = Order.check_availability(
+        [(p, by_code[p.code][1]) for p in products])
+    res = []
+    for product in products:
+        key, qty = by_code[product.code]
+        available = _available(availability.get(product.code), qty)
+        if available > 0:
+            res.append((key, Quote(context, product, product.cost_price,
+                                   available)))
+    return res
+
+
+class Plan(object):
+    def __init__(self, lines, quotes, errors):
+        # {context: [(product, quantity)]}
+        self.orders = collections.OrderedDict()
+        # {key: quantity} which no supplier can deliver
+        self.unfilled = {}
+        # {context: exception} of suppliers which couldn't be asked
+        self.errors = errors
+        self.cost = decimal.Decimal(0)
+
+        for key, qty in lines:
+            offers = sorted(quotes.get(key, []), key=lambda q: (
+                q.price is None, q.price))
+            for offer in offers:
+                if qty <= 0:
+                    break
+                take = min(qty, offer.quantity)
+                if isinstance(qty, (int, long)):
+                    # Partial quantities aren't ordered.
+                    take = int(take)
+                    if take <= 0:
+                        continue
+                self.orders.setdefault(offer.context, []).append(
+                    (offer.product, take))
+                if offer.price is not None:
+                    self.cost += offer.price * take
+                qty -= take
+            if qty > 0:
+                self.unfilled[key] = qty
+
+    def execute(self, finish=False, concurrency=8):
+        # Creates the orders of all suppliers at once and returns
+        # {context: order or exception}. Orders are only placed with
+        # finish, otherwise they can still be inspected and finished or
+        # rolled back.
+        def create(item):
+            context, lines = item
+            try:
+                order = context.get('Order').create(lines)
+                if finish:
+                    order.finish()
+                return context, order
+            except Exception, e:
+                return context, e
+
+        return dict(parallel(create, self.orders.items(), concurrency))
+
+
+def plan_order(contexts, lines, codes=None, concurrency=8):
+    # codes is {context: {key: code}}, lines are merged per key.
+    merged = collections.OrderedDict()
+    for key, qty in lines:
+        merged[key] = merged.get(key, 0) + qty
+    lines = merged.items()
+    codes = codes or {}
+
+    def ask(context):
+        try:
+            return context, quote(context, lines, codes.get(context)), None
+        except Exception, e:
+            return context, [], e
+
+    quotes = collections.defaultdict(list)
+    errors = {}
+    for context, offers, error in parallel(ask, contexts, concurrency):
+        if error is not None:
+            errors[context] = error
+        for key, offer in offers:
+            quotes[key].append(offer)
+    return Plan(lines, quotes, errors)
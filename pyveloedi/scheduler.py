@@ -0,0 +1,192 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Request scheduling per supplier.
+#
+# All contexts of a supplier URL share one Scheduler, which limits the
+# requests in flight and optionally their rate with a token bucket.
+# Waiting requests are served by priority class, INTERACTIVE before BULK,
+# and round robin between the contexts within a class. The priority is
+# set per thread:
+#
+#   scheduler.configure(url, rate=10, burst=20, concurrency=4)
+#   with scheduler.priority(scheduler.BULK):
+#       for product in Product.iter_read(codes):
+#           ...
+
+import collections
+import contextlib
+import threading
+import time
+
+INTERACTIVE = 0
+BULK = 1
+
+PRIORITY_NAMES = {
+    INTERACTIVE: 'interactive',
+    BULK: 'bulk',
+}
+
+# Requests in flight per supplier
+MAX_CONCURRENCY = 8
+
+_local = threading.local()
+
+
+def current_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level):
+    old = current_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = old
+
+
+def bound(func):
+    # Runs func with the priority of the calling thread, e.g. in a pool.
+    level = current_priority()
+
+    def wrapper(*args, **kwargs):
+        with priority(level):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class Scheduler(object):
+    def __init__(self, rate=None, burst=None, concurrency=MAX_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.active = 0
+        self._cond = threading.Condition()
+        self._tokens = None
+        self._refilled = time.time()
+        # priority -> {key: deque of tickets}
+        self._queues = dict((level, collections.OrderedDict())
+                            for level in PRIORITY_NAMES)
+
+    def configure(self, rate=None, burst=None, concurrency=MAX_CONCURRENCY):
+        with self._cond:
+            self.rate = rate
+            self.burst = burst
+            self.concurrency = concurrency
+            self._tokens = None
+            self._cond.notify_all()
+
+    def _take_token(self):
+        # Returns 0 if a token was taken, otherwise the seconds until the
+        # next one.
+        if self.rate is None:
+            return 0
+        burst = self.burst or self.rate
+        now = time.time()
+        if self._tokens is None:
+            self._tokens = burst
+        else:
+            self._tokens = min(
+                burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _head(self):
+        for level in sorted(self._queues):
+            queue = self._queues[level]
+            if queue:
+                return next(queue.itervalues())[0]
+        return None
+
+    def _remove(self, level, key, ticket):
+        queue = self._queues[level]
+        tickets = queue.pop(key)
+        tickets.remove(ticket)
+        if tickets:
+            # The key moves to the end of the round.
+            queue[key] = tickets
+
+    def queue_depth(self):
+        with self._cond:
+            return dict((PRIORITY_NAMES[level], sum(map(len, q.itervalues())))
+                        for level, q in self._queues.iteritems())
+
+    def acquire(self, key):
+        # Blocks until the request of key may be sent.
+        level = current_priority()
+        ticket = object()
+        with self._cond:
+            self._queues[level].setdefault(key, collections.deque()).append(
+                ticket)
+            try:
+                while True:
+                    wait = None
+                    if self._head() is ticket \
+                            and self.active < self.concurrency:
+                        wait = self._take_token()
+                        if not wait:
+                            break
+                    self._cond.wait(wait)
+            finally:
+                self._remove(level, key, ticket)
+                self._cond.notify_all()
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, context):
+        level = current_priority()
+        start = time.time()
+        self.acquire(context)
+        name = PRIORITY_NAMES[level]
+        context.metrics.timing('scheduler.wait.' + name, time.time() - start)
+        for queue, depth in self.queue_depth().iteritems():
+            context.metrics.gauge('scheduler.queued.' + queue, depth)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def for_url(url):
+    with _schedulers_lock:
+        if url not in _schedulers:
+            _schedulers[url] = Scheduler()
+        return _schedulers[url]
+
+
+def configure(url, rate=None, burst=None, concurrency=MAX_CONCURRENCY):
+    # Sets the limits of a supplier, rate is in requests per second.
+    for_url(url).configure(rate, burst, concurrency)
@@ -0,0 +1,131 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Cache for Product.search results.
+#
+# Results are cached per supplier, login, normalized keywords, offset,
+# limit and count mode. Fresh results are returned for ttl seconds. For
+# further stale seconds the cached result is still returned, while it is
+# refreshed in the background with bulk priority. The least recently used
+# results are evicted beyond size entries. One cache can be shared by
+# many contexts.
+#
+#   cache = SearchCache(ttl=300, stale=3600, size=10000)
+#   context.search_cache = cache
+
+import collections
+import threading
+import time
+
+from . import scheduler
+
+
+def normalize(keywords):
+    return tuple(' '.join(keywords).lower().split())
+
+
+class SearchCache(object):
+    def __init__(self, ttl=300, stale=3600, size=10000):
+        self.ttl = ttl
+        self.stale = stale
+        self.size = size
+        self._lock = threading.Lock()
+        # key -> (time, result), least recently used first
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(context, keywords, offset, limit, count):
+        return (context._url, context._userid, normalize(keywords), offset,
+                limit, bool(count))
+
+    @staticmethod
+    def _copy(result):
+        # Callers may modify the lists they get.
+        return list(result) if isinstance(result, list) else result
+
+    def _store(self, key, result):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), result)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _refresh(self, context, key, search, args):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                with scheduler.priority(scheduler.BULK):
+                    self._store(key, search(*args))
+            except Exception:
+                # The stale result is kept until it expires.
+                context.metrics.incr('search_cache.refresh_errors')
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def search(self, context, search, keywords, offset=0, limit=20,
+               count=False):
+        # Returns the cached result or calls
+        # search(keywords, offset, limit, count).
+        args = (keywords, offset, limit, count)
+        key = self._key(context, *args)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < self.ttl:
+                context.metrics.incr('search_cache.hits')
+                return self._copy(entry[1])
+            if age < self.ttl + self.stale:
+                context.metrics.incr('search_cache.stale_hits')
+                self._refresh(context, key, search, args)
+                return self._copy(entry[1])
+
+        context.metrics.incr('search_cache.misses')
+        result = search(*args)
+        self._store(key, result)
+        return self._copy(result)
+
+    def invalidate(self, context=None):
+        # Drops the results of a context's supplier and login, or all.
+        with self._lock:
+            if context is None:
+                self._entries.clear()
+                return
+            for key in self._entries.keys():
+                if key[:2] == (context._url, context._userid):
+                    del self._entries[key]
@@ -0,0 +1,325 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Compact binary format for product and order line snapshots.
+#
+# Models wrap lxml elements and context bound classes, so they can't be
+# pickled or shared between processes. Records are plain value objects
+# holding the parsed fields of a model. A stream starts with a header
+# (magic, version) followed by frames of (type, length, payload). Strings
+# are stored length prefixed, decimals as fixed point cents like
+# base.Decimal returns them.
+
+import decimal
+import struct
+
+from .base import LineBase
+
+MAGIC = 'PVE'
+VERSION = 1
+
+TYPE_PRODUCT = 1
+TYPE_LINE = 2
+
+_HEADER = struct.Struct('<3sB')
+_FRAME = struct.Struct('<BI')
+_CENT = decimal.Decimal('0.01')
+
+
+class SerializeException(Exception):
+    pass
+
+
+def _write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data, pos):
+    res = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        res |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return res, pos
+        shift += 7
+
+
+# Every value is prefixed so that None can be told apart from empty values.
+def _enc_string(buf, value):
+    if value is None:
+        buf.append(0)
+        return
+    value = unicode(value).encode('utf-8')
+    _write_varint(buf, len(value) + 1)
+    buf.extend(value)
+
+
+def _dec_string(data, pos):
+    length, pos = _read_varint(data, pos)
+    if length == 0:
+        return None, pos
+    end = pos + length - 1
+    return data[pos:end].decode('utf-8'), end
+
+
+def _enc_decimal(buf, value):
+    if value is None:
+        buf.append(0)
+        return
+    cents = int(decimal.Decimal(value).quantize(_CENT).scaleb(2))
+    # zigzag, shifted by one for None
+    _write_varint(buf, ((cents << 1) ^ (cents >> 63)) + 1)
+
+
+def _dec_decimal(data, pos):
+    value, pos = _read_varint(data, pos)
+    if value == 0:
+        return None, pos
+    value -= 1
+    cents = (value >> 1) ^ -(value & 1)
+    return decimal.Decimal(cents).scaleb(-2), pos
+
+
+def _enc_bool(buf, value):
+    buf.append(1 if value else 0)
+
+
+def _dec_bool(data, pos):
+    return bool(data[pos]), pos + 1
+
+
+def _enc_product(buf, value):
+    if value is None:
+        buf.append(0)
+        return
+    buf.append(1)
+    to_record(value).encode(buf)
+
+
+def _dec_product(data, pos):
+    if data[pos] == 0:
+        return None, pos + 1
+    return ProductRecord.decode(data, pos + 1)
+
+
+_CODECS = {
+    's': (_enc_string, _dec_string),
+    'd': (_enc_decimal, _dec_decimal),
+    'b': (_enc_bool, _dec_bool),
+    'p': (_enc_product, _dec_product),
+}
+
+
+class Record(object):
+    __slots__ = ()
+    _type = None
+    _fields = ()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self._fields):
+            raise TypeError('Too many arguments for %s'
+                            % self.__class__.__name__)
+        args += (None,) * (len(self._fields) - len(args))
+        for (name, _), value in zip(self._fields, args):
+            setattr(self, name, kwargs.get(name, value))
+
+    @classmethod
+    def from_model(cls, model):
+        values = []
+        for name, _ in cls._fields:
+            try:
+                values.append(getattr(model, name))
+            except AttributeError:
+                values.append(None)
+        return cls(*values)
+
+    def _values(self):
+        return tuple(getattr(self, name) for name, _ in self._fields)
+
+    def encode(self, buf):
+        for (_, kind), value in zip(self._fields, self._values()):
+            _CODECS[kind][0](buf, value)
+
+    @classmethod
+    def decode(cls, data, pos=0):
+        values = []
+        for _, kind in cls._fields:
+            value, pos = _CODECS[kind][1](data, pos)
+            values.append(value)
+        return cls(*values), pos
+
+    def __reduce__(self):
+        return (self.__class__, self._values())
+
+    def __eq__(self, other):
+        return (type(self) is type(other)
+                and self._values() == other._values())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.code)
+
+
+class ProductRecord(Record):
+    _type = TYPE_PRODUCT
+    _fields = (
+        ('code', 's'),
+        ('valid', 'b'),
+        ('replacement', 's'),
+        ('ean13', 's'),
+        ('name', 's'),
+        ('description', 's'),
+        ('manufacturer', 's'),
+        ('unit_code', 's'),
+        ('list_price', 'd'),
+        ('cost_price', 'd'),
+        ('availability', 's'),
+        ('available_quantity', 'd'),
+    )
+    __slots__ = tuple(name for name, _ in _fields)
+
+
+class LineRecord(Record):
+    _type = TYPE_LINE
+    _fields = (
+        ('product', 'p'),
+        ('quantity', 'd'),
+        ('unit_price', 'd'),
+        ('availability', 's'),
+        ('available_quantity', 'd'),
+    )
+    __slots__ = tuple(name for name, _ in _fields)
+
+    @classmethod
+    def from_model(cls, model):
+        res = super(LineRecord, cls).from_model(model)
+        if res.product is not None:
+            res.product = to_record(res.product)
+        return res
+
+    @property
+    def code(self):
+        return self.product is not None and self.product.code or None
+
+
+_TYPES = {
+    TYPE_PRODUCT: ProductRecord,
+    TYPE_LINE: LineRecord,
+}
+
+
+def to_record(obj):
+    if isinstance(obj, Record):
+        return obj
+    if isinstance(obj, LineBase):
+        return LineRecord.from_model(obj)
+    return ProductRecord.from_model(obj)
+
+
+def _frame(record):
+    record = to_record(record)
+    buf = bytearray()
+    record.encode(buf)
+    return _FRAME.pack(record._type, len(buf)) + str(buf)
+
+
+def _check_header(header):
+    if len(header) < _HEADER.size:
+        raise SerializeException('Truncated header.')
+    magic, version = _HEADER.unpack(header[:_HEADER.size])
+    if magic != MAGIC:
+        raise SerializeException('Not a pyveloedi stream.')
+    if version > VERSION:
+        raise SerializeException('Unsupported version %d.' % version)
+
+
+class Writer(object):
+    def __init__(self, fp):
+        self._fp = fp
+        fp.write(_HEADER.pack(MAGIC, VERSION))
+
+    def write(self, record):
+        self._fp.write(_frame(record))
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+
+def _iter_frames(read):
+    while True:
+        frame = read(_FRAME.size)
+        if not frame:
+            return
+        if len(frame) < _FRAME.size:
+            raise SerializeException('Truncated frame.')
+        rtype, length = _FRAME.unpack(frame)
+        payload = read(length)
+        if len(payload) < length:
+            raise SerializeException('Truncated record.')
+        # Skip record types of newer versions.
+        if rtype in _TYPES:
+            yield _TYPES[rtype].decode(bytearray(payload))[0]
+
+
+def dump(records, fp):
+    Writer(fp).write_all(records)
+
+
+def load(fp):
+    # Generator, records are decoded while reading the stream.
+    _check_header(fp.read(_HEADER.size))
+    return _iter_frames(fp.read)
+
+
+def dumps(records):
+    return _HEADER.pack(MAGIC, VERSION) + ''.join(map(_frame, records))
+
+
+def loads(data):
+    _check_header(data)
+    pos = [_HEADER.size]
+
+    def read(size):
+        res = data[pos[0]:pos[0] + size]
+        pos[0] += size
+        return res
+
+    return list(_iter_frames(read))
+
+
+# Single values, e.g. as cache entries.
+def pack(record):
+    return dumps([record])
+
+
+def unpack(data):
+    res = loads(data)
+    if len(res) != 1:
+        raise SerializeException('Expected a single record.')
+    return res[0]
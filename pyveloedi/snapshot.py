@@ -0,0 +1,220 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Immutable catalog snapshots for memory mapping.
+#
+# The file holds one row per product, sorted by code, in fixed width
+# columns: amounts as int64 hundredths, strings as uint32 offsets into a
+# table of length prefixed UTF-8 strings and the valid flag as a byte.
+# Readers map the file and look codes up by binary search on the code
+# column, nothing is loaded up front. All processes mapping the same file
+# share its pages.
+#
+#   snapshot.write(Product.iter_read(codes), 'catalog.snap')
+#   with snapshot.Snapshot('catalog.snap') as snap:
+#       record = snap.get(code)
+
+import decimal
+import mmap
+import os
+import struct
+
+from .columnar import MISSING, amount_cents
+from .serialize import ProductRecord
+
+MAGIC = 'PVSN'
+VERSION = 1
+
+AMOUNTS = ('list_price', 'cost_price', 'available_quantity')
+STRINGS = ('code', 'replacement', 'ean13', 'name', 'description',
+           'manufacturer', 'unit_code', 'availability')
+
+NONE = 0xffffffff
+
+# magic, version, rows, string table offset, column offsets
+_HEADER = struct.Struct('<4sII Q %dQ' % (len(AMOUNTS) + len(STRINGS) + 1))
+_LENGTH = struct.Struct('<I')
+
+
+class SnapshotException(Exception):
+    pass
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+class _Strings(object):
+    # String table, equal strings are stored once.
+    def __init__(self):
+        self.data = bytearray()
+        self._offsets = {}
+
+    def add(self, value):
+        if value is None:
+            return NONE
+        value = unicode(value).encode('utf-8')
+        offset = self._offsets.get(value)
+        if offset is None:
+            offset = self._offsets[value] = len(self.data)
+            self.data += _LENGTH.pack(len(value))
+            self.data += value
+        return offset
+
+
+def write(products, path):
+    # Writes products or records, the last one of a code wins. The file
+    # is replaced atomically, mapped readers keep the old version.
+    rows = {}
+    for product in products:
+        code = getattr(product, 'code', None)
+        if code is None:
+            continue
+        valid = getattr(product, 'valid', False)
+        rows[unicode(code).encode('utf-8')] = (
+            valid,
+            [amount_cents(product, name) for name in AMOUNTS],
+            [getattr(product, name, None) for name in STRINGS])
+
+    codes = sorted(rows)
+    strings = _Strings()
+    valid = bytearray()
+    amounts = [[] for name in AMOUNTS]
+    offsets = [[] for name in STRINGS]
+    for code in codes:
+        flag, cents, values = rows[code]
+        valid.append(1 if flag else 0)
+        for column, value in zip(amounts, cents):
+            column.append(value)
+        for column, value in zip(offsets, values):
+            column.append(strings.add(value))
+
+    count = len(codes)
+    columns = [struct.pack('<%dq' % count, *column) for column in amounts]
+    columns += [struct.pack('<%dI' % count, *column) for column in offsets]
+    columns.append(str(valid))
+
+    pos = _HEADER.size
+    positions = []
+    for column in columns:
+        pos = _align(pos)
+        positions.append(pos)
+        pos += len(column)
+    strings_pos = _align(pos)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, count, strings_pos, *positions))
+        for column, pos in zip(columns, positions):
+            f.write('\0' * (pos - f.tell()))
+            f.write(column)
+        f.write('\0' * (strings_pos - f.tell()))
+        f.write(str(strings.data))
+    os.rename(tmp, path)
+    return count
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < _HEADER.size:
+            raise SnapshotException('Truncated snapshot.')
+        header = _HEADER.unpack_from(self._mm)
+        magic, version, self._count, self._strings = header[:4]
+        if magic != MAGIC:
+            raise SnapshotException('Not a catalog snapshot.')
+        if version > VERSION:
+            raise SnapshotException('Unsupported version %d.' % version)
+        positions = header[4:]
+        self._amounts = dict(zip(AMOUNTS, positions))
+        self._offsets = dict(zip(STRINGS, positions[len(AMOUNTS):]))
+        self._valid = positions[-1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+
+    def __len__(self):
+        return self._count
+
+    def _raw_string(self, name, row):
+        offset, = _LENGTH.unpack_from(self._mm, self._offsets[name] + 4 * row)
+        if offset == NONE:
+            return None
+        start = self._strings + offset
+        length, = _LENGTH.unpack_from(self._mm, start)
+        start += _LENGTH.size
+        return self._mm[start:start + length]
+
+    def string(self, name, row):
+        value = self._raw_string(name, row)
+        return value.decode('utf-8') if value is not None else None
+
+    def cents(self, name, row):
+        # The amount in hundredths, None if the product has none.
+        value, = struct.unpack_from('<q', self._mm,
+                                    self._amounts[name] + 8 * row)
+        return None if value == MISSING else value
+
+    def amount(self, name, row):
+        value = self.cents(name, row)
+        if value is None:
+            return None
+        return decimal.Decimal(value).scaleb(-2)
+
+    def find(self, code):
+        # Row of code or -1.
+        key = unicode(code).encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw_string('code', mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._raw_string('code', lo) == key:
+            return lo
+        return -1
+
+    def __contains__(self, code):
+        return self.find(code) >= 0
+
+    def record(self, row):
+        values = dict((name, self.string(name, row)) for name in STRINGS)
+        values.update((name, self.amount(name, row)) for name in AMOUNTS)
+        values['valid'] = self._mm[self._valid + row] != '\0'
+        return ProductRecord(**values)
+
+    def get(self, code):
+        row = self.find(code)
+        return self.record(row) if row >= 0 else None
+
+    def __iter__(self):
+        # Records in code order.
+        for row in xrange(self._count):
+            yield self.record(row)
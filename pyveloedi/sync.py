@@ -0,0 +1,162 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Incremental catalog synchronisation.
+#
+# The catalog is enumerated with Product.iter_search and the codes are read
+# in batches. Every item's source is hashed and compared with the hashes of
+# the last completed sync, so only inserted, updated and removed products
+# are reported. The hashes are saved to a JSON file when a sync completes.
+# During a sync, the hashes read since the last checkpoint are appended to
+# a run log next to it (path + '.run'), so checkpoints only write what
+# changed. An interrupted sync resumes at the last checkpoint. Changes
+# between the checkpoint and the interruption are reported again on resume.
+
+import hashlib
+import json
+import os
+
+from lxml import etree
+
+from . import serialize
+from .base import chunks
+
+INSERTED = 'inserted'
+UPDATED = 'updated'
+REMOVED = 'removed'
+
+
+def digest(product):
+    data = getattr(product, '_data', None)
+    if data is None:
+        # Records of the process pool don't carry the source element.
+        data = serialize.pack(product)
+    else:
+        data = etree.tostring(data, method='c14n')
+    return hashlib.sha1(data).hexdigest()
+
+
+class CatalogSync(object):
+    def __init__(self, context, keywords, path, page_size=100,
+                 batch_size=None, checkpoint_every=1000):
+        self._Product = context.get('Product')
+        self._keywords = keywords
+        self._path = path
+        self._page_size = page_size
+        self._batch_size = batch_size
+        self._checkpoint_every = checkpoint_every
+        self._log_path = path + '.run'
+        self._hashes = {}
+        self._run = None
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                state = json.load(f)
+            self._hashes = state['hashes']
+            # Older versions kept the run in the state file.
+            self._run = state.get('run')
+        if os.path.exists(self._log_path):
+            self._load_log()
+
+    def _load_log(self):
+        run = self._run or {'offset': 0, 'seen': {}}
+        with open(self._log_path, 'r+') as f:
+            valid = 0
+            while True:
+                line = f.readline()
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The end, or a checkpoint that was interrupted while
+                    # writing. It is cut off, later ones append to it.
+                    f.truncate(valid)
+                    break
+                run['offset'] = entry['offset']
+                run['seen'].update(entry['seen'])
+                valid = f.tell()
+        self._run = run
+
+    def _checkpoint(self, seen):
+        # Appends the hashes read since the last checkpoint.
+        with open(self._log_path, 'a') as f:
+            f.write(json.dumps({'offset': self._run['offset'],
+                                'seen': seen}) + '\n')
+
+    def _save(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'hashes': self._hashes}, f)
+        os.rename(tmp, self._path)
+        if os.path.exists(self._log_path):
+            os.remove(self._log_path)
+
+    @property
+    def resuming(self):
+        return self._run is not None
+
+    def run(self):
+        # Generator yielding (event, code, product) for every change.
+        # product is None for removed codes.
+        if self._run is None:
+            self._run = {'offset': 0, 'seen': {}}
+        seen = self._run['seen']
+        unsaved = {}
+        saved_offset = self._run['offset']
+
+        # The catalog may have changed since the last search.
+        codes = self._Product.iter_search(
+            self._keywords, self._run['offset'], self._page_size, fresh=True)
+        batch_size = self._batch_size or self._Product._ctx.batch_tuner.size
+        for batch in chunks(codes, batch_size):
+            for product in self._Product.read(batch):
+                if not product.valid:
+                    continue
+                code = product.code
+                h = digest(product)
+                old = self._hashes.get(code)
+                seen[code] = unsaved[code] = h
+                if old is None:
+                    yield INSERTED, code, product
+                elif old != h:
+                    yield UPDATED, code, product
+
+            self._run['offset'] += len(batch)
+            if self._run['offset'] - saved_offset >= self._checkpoint_every:
+                self._checkpoint(unsaved)
+                unsaved = {}
+                saved_offset = self._run['offset']
+
+        removed = [code for code in self._hashes if code not in seen]
+        for code in removed:
+            yield REMOVED, code, None
+
+        self._hashes = seen
+        self._run = None
+        self._save()
+
+        index = self._Product._ctx.index
+        if index is not None:
+            index.remove(removed)
+            if index.path is not None:
+                index.save()
@@ -0,0 +1,157 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Batch sizes of item detail requests per supplier.
+#
+# The batch size grows by a constant step after every full batch which was
+# answered in time, and is cut by a factor after errors, slow or very large
+# responses (additive increase, multiplicative decrease). All contexts of a
+# supplier URL share one tuner. Bulk reads without an explicit batch size
+# use it. The learned sizes can be kept in a JSON file:
+#
+#   tuning.persist('batch_sizes.json')
+#   for product in Product.iter_read(codes):
+#       ...
+
+import atexit
+import json
+import os
+import threading
+import time
+
+
+class BatchTuner(object):
+    INITIAL = 100
+    MINIMUM = 10
+    MAXIMUM = 1000
+    # Seconds and bytes of a response above which the size is cut.
+    MAX_LATENCY = 10.0
+    MAX_BYTES = 4 * 1024 * 1024
+    INCREASE = 10
+    DECREASE = 0.5
+
+    def __init__(self, size=INITIAL, minimum=MINIMUM, maximum=MAXIMUM,
+                 max_latency=MAX_LATENCY, max_bytes=MAX_BYTES,
+                 increase=INCREASE, decrease=DECREASE, on_change=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_latency = max_latency
+        self.max_bytes = max_bytes
+        self.increase = increase
+        self.decrease = decrease
+        self._size = max(minimum, min(maximum, size))
+        self._lock = threading.Lock()
+        self._on_change = on_change
+
+    def size(self):
+        return self._size
+
+    def record(self, size, latency=None, nbytes=None, error=False):
+        # Result of a request for size codes, latency is None for errors.
+        with self._lock:
+            old = self._size
+            if error or latency is None or latency > self.max_latency \
+                    or (nbytes is not None and nbytes > self.max_bytes):
+                self._size = max(self.minimum,
+                                 min(old, int(size * self.decrease)))
+            elif size >= old:
+                # Only full batches show the current size is fine.
+                self._size = min(self.maximum, old + self.increase)
+            changed = self._size != old
+        if changed and self._on_change is not None:
+            self._on_change()
+
+
+class Tuners(object):
+    # Tuners per supplier URL, optionally saved to a JSON file at most
+    # every save_interval seconds and at exit.
+    def __init__(self, path=None, save_interval=60):
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._tuners = {}
+        self._sizes = {}
+        self._saved = 0
+        self._dirty = False
+
+    def get(self, url):
+        with self._lock:
+            tuner = self._tuners.get(url)
+            if tuner is None:
+                tuner = self._tuners[url] = BatchTuner(
+                    self._sizes.get(url, BatchTuner.INITIAL),
+                    on_change=self._changed)
+            return tuner
+
+    def _changed(self):
+        self._dirty = True
+        if self.path is not None \
+                and time.time() - self._saved > self.save_interval:
+            self.save()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            sizes = json.load(f)
+        with self._lock:
+            self._sizes.update(sizes)
+            for url, tuner in self._tuners.iteritems():
+                if url in sizes:
+                    tuner._size = max(tuner.minimum,
+                                      min(tuner.maximum, sizes[url]))
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            self._sizes.update((url, tuner.size())
+                               for url, tuner in self._tuners.iteritems())
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._sizes, f)
+            os.rename(tmp, self.path)
+            self._saved = time.time()
+            self._dirty = False
+
+
+_tuners = Tuners()
+
+
+@atexit.register
+def _save():
+    if _tuners._dirty:
+        try:
+            _tuners.save()
+        except Exception:
+            pass
+
+
+def for_url(url):
+    return _tuners.get(url)
+
+
+def persist(path, save_interval=60):
+    # Loads and keeps the learned sizes in path.
+    _tuners.path = path
+    _tuners.save_interval = save_interval
+    _tuners.load()
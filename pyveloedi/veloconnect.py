@@ -22,12 +22,27 @@
 
 from lxml import etree
 from lxml.builder import ElementMaker
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import atexit
+import codecs
+import collections
+import contextlib
+import itertools
+import threading
+import time
 import urllib
 import urllib2
 import re
+import weakref
 
-from .base import ProductBase, ContextBase, EDIException, OrderBase, Model
+from .base import (ProductBase, ContextBase, EDIException, OrderBase, LineBase,
+                   Model, TRANSPORT_ERRORS)
+from .metrics import EWMA
+from .serialize import ProductRecord
 import base
+import scheduler
+import searchcache
 
 
 CAC_NAMESPACE = 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-1.0'
@@ -46,10 +61,66 @@ NAMESPACES = {
     'vct': VCT_NAMESPACE,
 }
 
+
+# Request templates.
+# Requests are described by light weight nodes instead of element trees and
+# streamed with etree.xmlfile, so large entry lists are never built as a
+# tree. Nodes are immutable once built and can be shared, like the
+# authentication nodes cached per context.
+class Node(object):
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, *children, **attrib):
+        self.tag = tag
+        self.attrib = dict((k, v) for k, v in attrib.iteritems()
+                           if v is not None)
+        self.children = list(children)
+
+    def append(self, child):
+        self.children.append(child)
+
+    def extend(self, children):
+        # Iterables are kept as they are and consumed while writing.
+        self.children.append(children)
+
+    def write(self, xf, nsmap=None):
+        with xf.element(self.tag, self.attrib, nsmap=nsmap):
+            _write_children(xf, self.children)
+
+    def tostring(self):
+        buf = BytesIO()
+        with etree.xmlfile(buf, encoding='utf-8') as xf:
+            xf.write_declaration()
+            self.write(xf, NAMESPACES)
+        return buf.getvalue()
+
+
+def _write_children(xf, children):
+    for child in children:
+        if isinstance(child, Node):
+            child.write(xf)
+        elif hasattr(child, '__iter__'):
+            _write_children(xf, child)
+        else:
+            xf.write(unicode(child))
+
+
+class NodeMaker(object):
+    def __init__(self, namespace):
+        self._namespace = namespace
+
+    def __getattr__(self, name):
+        tag = '{%s}%s' % (self._namespace, name)
+
+        def make(*children, **attrib):
+            return Node(tag, *children, **attrib)
+        return make
+
+
 #
 # Veloconnect Order
 #
-VCO = ElementMaker(namespace=VCO_NAMESPACE, nsmap=NAMESPACES)
+VCO = NodeMaker(VCO_NAMESPACE)
 GetItemDetailsRequest = VCO.GetItemDetailsRequest
 GetItemDetailsListRequest = VCO.GetItemDetailsListRequest
 RequestEntry = VCO.RequestEntry
@@ -62,31 +133,32 @@ FinishOrderRequest = VCO.FinishOrderRequest
 #
 # Common Aggregate Components
 #
-CAC = ElementMaker(namespace=CAC_NAMESPACE)
+CAC = NodeMaker(CAC_NAMESPACE)
 SellersItemIdentification = CAC.SellersItemIdentification
 ID = CAC.ID
 
 #
 # Common Basic Components
 #
-CBC = ElementMaker(namespace=CBC_NAMESPACE)
+CBC = NodeMaker(CBC_NAMESPACE)
 Quantity = CBC.Quantity
 
 #
 # Veloconnect Transaction
 #
-VCT = ElementMaker(namespace=VCT_NAMESPACE)
+VCT = NodeMaker(VCT_NAMESPACE)
 BuyersID = VCT.BuyersID
 Credential = VCT.Credential
 Password = VCT.Password
 TransactionID = VCT.TransactionID
 RollbackRequest = VCT.RollbackRequest
 IsTest = VCT.IsTest
+XML_ISTEST = IsTest('1')
 
 #
 # Veloconnect Catalog
 #
-VCC = ElementMaker(namespace=VCC_NAMESPACE, nsmap=NAMESPACES)
+VCC = NodeMaker(VCC_NAMESPACE)
 CreateTextSearchRequest = VCC.CreateTextSearchRequest
 SearchString = VCC.SearchString
 SearchResultRequest = VCC.SearchResultRequest
@@ -99,6 +171,9 @@ XML_POST_HEADER = {
     'Content-Type': 'application/xml',
 }
 
+BINDING_POST = 'XML-POST'
+BINDING_GET = 'URL-GET'
+
 ERR_NONE = 200
 ERR_ANY = 400
 ERR_NOT_SUPPORTED = 404
@@ -113,6 +188,9 @@ ERR_ILLEGAL_OP = 430
 ERR_ILLEGAL_ISTEST = 435
 ERR_INTERNAL = 500
 
+# Concurrent transactions per supplier
+MAX_TRANSACTIONS = 8
+
 ERR_CODES = {
     ERR_ANY: 'General error.',
     ERR_NOT_SUPPORTED: 'Request not supported.',
@@ -134,102 +212,369 @@ class VeloConnectException(EDIException):
         self._msg = ERR_CODES[code] + ' (Code: %d)' % code
 
 
+class InvalidResponseException(VeloConnectException):
+    def __init__(self):
+        self._code = ERR_INTERNAL
+        self._msg = 'Invalid XML response.'
+
+
+# Response parsing.
+# Some suppliers return invalid XML. Responses which are not well formed
+# are passed through the cleaners and parsed again in recover mode.
+_ENTITY_EXP = re.compile(
+    r'&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)')
+_ENCODING_EXP = re.compile(r'^\s*<\?xml[^>]*encoding=["\']([^"\']+)')
+
+
+def clean_entities(data):
+    # HTML entities like &nbsp; and unescaped ampersands.
+    return _ENTITY_EXP.sub('&amp;', data.replace('&nbsp;', '&#160;'))
+
+
+def _cp1252_fallback(err):
+    return err.object[err.start:err.end].decode('cp1252', 'replace'), err.end
+
+codecs.register_error('pyveloedi-cp1252', _cp1252_fallback)
+
+
+def clean_encoding(data):
+    # Windows-1252 text within UTF-8 responses.
+    match = _ENCODING_EXP.match(data)
+    if match is not None and match.group(1).lower() not in ('utf-8', 'utf8'):
+        return data
+    return data.decode('utf-8', 'pyveloedi-cp1252').encode('utf-8')
+
+
+CLEANERS = (clean_encoding, clean_entities)
+
+_parsers = threading.local()
+
+
+def parse_response(data, recover=True, cleaners=CLEANERS):
+    # Returns the root element, None if nothing could be parsed, and
+    # whether the response had to be recovered.
+    try:
+        return etree.fromstring(data), False
+    except etree.XMLSyntaxError:
+        if not recover:
+            return None, False
+
+    parser = getattr(_parsers, 'recover', None)
+    if parser is None:
+        parser = _parsers.recover = etree.XMLParser(recover=True)
+    for clean in cleaners:
+        data = clean(data)
+    try:
+        return etree.fromstring(data, parser), True
+    except etree.XMLSyntaxError:
+        return None, True
+
+
+class BindingStats(object):
+    # Smoothed latency and error rate of one binding of an operation.
+    def __init__(self, alpha=0.2):
+        self.latency = EWMA(alpha)
+        self.errors = EWMA(alpha)
+        self.failed = None
+        self.lock = threading.Lock()
+
+    def success(self, latency):
+        with self.lock:
+            self.latency.update(latency)
+            self.errors.update(0)
+
+    def failure(self):
+        with self.lock:
+            self.errors.update(1)
+            self.failed = time.time()
+
+    def healthy(self, max_error_rate, retry):
+        # Failing bindings get another chance retry seconds after their
+        # last failure.
+        return (self.errors.value is None
+                or self.errors.value <= max_error_rate
+                or time.time() - self.failed > retry)
+
+
 class Context(ContextBase):
     MAX_FETCH_TRIES = 3
-
-    def __init__(self, url, userid, passwd, istest=False, log=False):
+    # Binding selection: A binding above MAX_ERROR_RATE is skipped for
+    # BINDING_RETRY seconds. Every EXPLORE_EVERY requests the second best
+    # binding is used, so its latency stays up to date.
+    MAX_ERROR_RATE = 0.5
+    BINDING_RETRY = 60
+    EXPLORE_EVERY = 20
+    # Responses larger than this are parsed in the process pool.
+    POOL_THRESHOLD = 256 * 1024
+    MAX_PENDING_PARSES = 8
+
+    def __init__(self, url, userid, passwd, istest=False, log=False,
+                 pool=None, pool_threshold=POOL_THRESHOLD,
+                 max_transactions=MAX_TRANSACTIONS, recover=True,
+                 cleaners=CLEANERS):
         self._istest = istest
         super(Context, self).__init__(url, userid, passwd, log)
+        self._recover = recover
+        self._cleaners = cleaners
         self._bindings = None
+        self._bindings_lock = threading.Lock()
+        self._binding_stats = {}
+        self._requests = collections.defaultdict(lambda: itertools.count(1))
+        # Optional multiprocessing.Pool for parsing large responses.
+        self._pool = pool
+        self._pool_threshold = pool_threshold
+
+        # Authentication is the same for all requests of this context.
+        self._xml_auth = [
+            BuyersID(self._userid),
+            Credential(Password(self._passwd)),]
+        self._xml_istest = IsTest(str(int(self._istest)))
+        self.transactions = TransactionManager(self, max_transactions)
+        self._url_auth = urllib.urlencode([
+            ('BuyersID', self._userid),
+            ('Password', self._passwd),])
+        self._url_istest = urllib.urlencode([('IsTest', self._istest)])
 
     def _load_bindings(self):
         if self._bindings is not None:
             return
-        gp = GetProfile(context=self)
-        self._bindings = gp.get_bindings()
+        with self._bindings_lock:
+            if self._bindings is None:
+                gp = GetProfile(context=self)
+                self._bindings = gp.get_bindings()
 
-    def check(self):
+    def close(self):
+        # Rolls back all open transactions.
+        self.transactions.close()
+
+    def probe(self):
         # Simply pulling the bindings does often work even if the
-        # credentials are worng.
-        try:
-            Product = self.get('Product')
-            Product.search(['NOTHING'])
-        except:
-            return False
-        return True
+        # credentials are worng, so a text search is run.
+        self._load_bindings()
+        self.transactions.probe()
+
+    def supports(self, operation):
+        # Whether the supplier offers a binding the operation implements.
+        self._load_bindings()
+        return any(operation.implements(binding)
+                   for binding in self._bindings.get(operation._name, []))
 
     def get(self, clsname):
         self._load_bindings()
         if clsname == 'Product':
-            return Product.copy(self)
+            return self._bind(Product)
         elif clsname == 'Order':
-            return Order.copy(self)
+            return self._bind(Order)
         return None
 
-    def dispatch_request(self, request):
-        if request._name not in self._bindings:
+    def binding_stats(self, name, binding):
+        key = (name, binding)
+        stats = self._binding_stats.get(key)
+        if stats is None:
+            stats = self._binding_stats.setdefault(key, BindingStats())
+        return stats
+
+    def select_bindings(self, request):
+        # The bindings advertised for the request which it implements,
+        # the fastest healthy one first. Unmeasured bindings are tried
+        # first, in the order of the profile.
+        candidates = [b for b in self._bindings.get(request._name, [])
+                      if request.implements(b)]
+        if not candidates:
             raise VeloConnectException(ERR_NOT_SUPPORTED)
 
-        ntry = 0
-        while ntry < self.MAX_FETCH_TRIES:
-            if self._bindings[request._name] == 'XML-POST':
-                xml = etree.tostring(request.get_xml(), pretty_print=True)
-                res = self.query_post(xml)
-            else:
-                res = self.query_get(request.get_url_args())
-
+        def key(binding):
+            stats = self.binding_stats(request._name, binding)
+            healthy = stats.healthy(self.MAX_ERROR_RATE, self.BINDING_RETRY)
+            return (not healthy, stats.latency.value or 0)
+        candidates.sort(key=key)
+
+        n = next(self._requests[request._name])
+        if n % self.EXPLORE_EVERY == 0 and len(candidates) > 1 \
+                and not key(candidates[1])[0]:
+            candidates[0], candidates[1] = candidates[1], candidates[0]
+        return candidates
+
+    def _send(self, binding, request, *args):
+        # Returns the response and its latency, without the time spent
+        # waiting in the scheduler.
+        if binding == BINDING_POST:
+            data = request.get_xml(*args).tostring()
+            query = lambda: self.query_post(data)
+        else:
+            params = request.get_url_args(*args)
+            query = lambda: self.query_get(params)
+
+        with self.scheduler.slot(self):
+            start = time.time()
+            res = query()
+            return res, time.time() - start
+
+    def _fetch(self, request, *args):
+        # Returns the binding used and the response. Falls back to the
+        # next binding on transport errors, unless the request must not
+        # be sent twice.
+        self.check_breaker()
+        bindings = self.select_bindings(request)
+        for binding in bindings:
+            stats = self.binding_stats(request._name, binding)
+            metric = 'bindings.%s.%s' % (request._name, binding)
+            try:
+                res, latency = self._send(binding, request, *args)
+            except TRANSPORT_ERRORS, e:
+                stats.failure()
+                self.metrics.incr(metric + '.errors')
+                if not request._idempotent or binding == bindings[-1]:
+                    request.observe(None, None, *args)
+                    raise
+                self.log('Binding %s failed' % binding, repr(e))
+                continue
+
+            request.observe(latency, len(res), *args)
+            stats.success(latency)
+            self.metrics.timing(metric + '.latency', latency)
             self.log('XML response', res)
+            return binding, res
+
+    def fetch(self, request, *args):
+        return self._fetch(request, *args)[1]
+
+    def parse(self, data, request=None, args=()):
+        # The root of the response or None if it can't be used.
+        root, recovered = parse_response(data, self._recover, self._cleaners)
+        if recovered:
+            self.log('XMLSyntaxError', 'Parsed in recover mode.')
+            self.metrics.incr('responses.recovered')
+        if root is None or not valid_response(root, request, args,
+                                              recovered):
+            return None
+        return root
 
-            # Sometimes some supplier return invalid XML.
-            # Normally when requesting the data again it will be fine.
-            try:
-                root = etree.fromstring(res)
+    def dispatch_request(self, request, *args):
+        ntry = 0
+        while True:
+            binding, res = self._fetch(request, *args)
+            root = self.parse(res, request, args)
+            if root is not None:
                 break
-            except etree.XMLSyntaxError:
-                self.log('XMLSyntaxError', 'Will fetch xml again.')
-                ntry += 1
 
-        rcode, = root.xpath('//vct:ResponseCode', namespaces=NAMESPACES)
-        err = int(rcode.text)
+            # Normally when requesting the data again it will be fine.
+            self.binding_stats(request._name, binding).failure()
+            ntry += 1
+            if not request._idempotent or ntry >= self.MAX_FETCH_TRIES:
+                raise InvalidResponseException()
+            self.log('Invalid response', 'Will fetch xml again.')
+            self.metrics.incr('responses.refetched')
+
+        err = response_code(root)
         if err != ERR_NONE:
             raise VeloConnectException(err)
 
         return root
 
     def query_get(self, params):
-        params += [('BuyersID', self._userid),
-                   ('Password', self._passwd),
-                   ('IsTest', self._istest),]
-
-        params = urllib.urlencode(params)
-        url = '%s?%s' % (self._url, params)
+        url = '%s?%s&%s' % (self._url, urllib.urlencode(params),
+                            self._url_auth)
+        # Requests may enforce test mode on their own.
+        if 'IsTest' not in dict(params):
+            url += '&' + self._url_istest
         self.log('URL for GET request', url)
         return urllib2.urlopen(url).read()
 
     def query_post(self, data):
-        data = '<?xml version="1.0" encoding="utf-8"?>\n' + data
         self.log('XML for POST request', data)
         req = urllib2.Request(self._url, data, XML_POST_HEADER)
         return urllib2.urlopen(req).read()
 
 
+def response_code(root):
+    # None if the response has no valid code.
+    rcode = root.xpath('//vct:ResponseCode', namespaces=NAMESPACES)
+    if len(rcode) != 1 or not (rcode[0].text or '').strip().isdigit():
+        return None
+    return int(rcode[0].text)
+
+
+def valid_response(root, request=None, args=(), recovered=False):
+    # Checks the code and the payload expected by the request. Recovered
+    # responses may have lost elements, so they must be complete.
+    err = response_code(root)
+    if err is None:
+        return False
+    if err != ERR_NONE or request is None:
+        return True
+    if request._response is not None and root.tag != request._response:
+        return False
+    return not recovered or request.complete(root, *args)
+
+
+def item_details(root, replacements=False):
+    items = root.xpath(
+            '/vco:GetItemDetailsListResponse/vco:ItemDetail',
+            namespaces=NAMESPACES)
+
+    res = []
+    for item in items:
+        product = Product(item)
+        # return only products without replacement
+        if replacements or product.replacement is None:
+            res.append(product)
+
+    return res
+
+
+def parse_item_details(data, codes, recover=True, cleaners=CLEANERS):
+    # Runs in the process pool, so only plain records are returned.
+    root, recovered = parse_response(data, recover, cleaners)
+    if root is None or not valid_response(root, GetItemDetailsList,
+                                          (codes,), recovered):
+        return None, None
+
+    err = response_code(root)
+    if err != ERR_NONE:
+        return err, None
+    return err, map(ProductRecord.from_model, item_details(root))
+
+
 class Operation(object):
+    # Operations don't keep state between calls, the arguments of execute
+    # are passed through dispatch_request to get_url_args() and get_xml().
+    # So one context can be used by many threads at once.
+    # Requests which are not idempotent are never sent twice.
+    # _response is the tag of the root element of successful responses,
+    # if known.
+    _idempotent = True
+    _response = None
+
     def __init__(self, context):
         self._ctx = context
+        self._xml_auth = context._xml_auth
+        self._xml_istest = context._xml_istest
 
-        self._xml_auth = [
-            BuyersID(self._ctx._userid),
-            Credential(Password(self._ctx._passwd)),]
-        self._xml_istest = IsTest(str(int(self._ctx._istest)))
-
-    def get_url_args(self):
+    def get_url_args(self, *args):
         raise NotImplementedError(
             'URL binding not implemented for %s.' % self._name)
 
-    def get_xml(self):
+    def get_xml(self, *args):
         raise NotImplementedError(
             'XML binding not implemented for %s.' % self._name)
 
+    def observe(self, latency, nbytes, *args):
+        # Called once per request with the outcome of the last binding
+        # tried, latency is None if it failed.
+        pass
+
+    @classmethod
+    def complete(cls, root, *args):
+        # Whether a recovered response contains everything requested.
+        return True
+
+    @classmethod
+    def implements(cls, binding):
+        method = 'get_xml' if binding == BINDING_POST else 'get_url_args'
+        return (getattr(cls, method).im_func
+                is not getattr(Operation, method).im_func)
+
     def execute(self):
         self._ctx.dispatch_request(self)
 
@@ -237,19 +582,18 @@ class Operation(object):
 class Rollback(Operation):
     _name = 'Rollback'
 
-    def get_url_args(self):
+    def get_url_args(self, tan):
         return [('RequestName', 'RollbackRequest'),
-                ('TransactionID', self._tan),]
+                ('TransactionID', tan),]
 
-    def get_xml(self):
+    def get_xml(self, tan):
         res = RollbackRequest()
         res.extend(self._xml_auth)
-        res.append(TransactionID(self._tan))
+        res.append(TransactionID(tan))
         return res
 
     def execute(self, tan):
-        self._tan = tan
-        self._ctx.dispatch_request(self)
+        self._ctx.dispatch_request(self, tan)
 
 
 class GetProfile(Operation):
@@ -262,6 +606,8 @@ class GetProfile(Operation):
                 '/vcp:GetProfileResponse/vcp:VeloconnectProfile/vcp:Implements',
                 namespaces=NAMESPACES)
 
+        # All bindings are kept per operation, XML-POST first. The
+        # context picks one per request by its measured latency.
         find = lambda path: impl.find(path, namespaces=NAMESPACES)
         bindings = {}
         for impl in implements:
@@ -270,11 +616,16 @@ class GetProfile(Operation):
             if op is None:
                 op = find('vcp:Operation')
 
-            # Overwrite URL bindings in favor of XML-POST
             if binding.text in ('XML-POST', 'XML-POST-S'):
-                bindings[op.text] = 'XML-POST'
-            elif op.text not in bindings:
-                bindings[op.text] = binding.text
+                binding = BINDING_POST
+            else:
+                binding = BINDING_GET
+            known = bindings.setdefault(op.text, [])
+            if binding not in known:
+                if binding == BINDING_POST:
+                    known.insert(0, binding)
+                else:
+                    known.append(binding)
 
         return bindings
 
@@ -283,7 +634,9 @@ class GetClassificationScheme(Operation):
     _name = 'GetClassificationScheme'
 
     def get_xml(self):
-        return GetClassificationSchemeRequest(self._xml_auth)
+        res = GetClassificationSchemeRequest()
+        res.extend(self._xml_auth)
+        return res
 
     def execute(self):
         res = self._ctx.dispatch_request(self)
@@ -292,176 +645,488 @@ class GetClassificationScheme(Operation):
 class GetItemDetails(Operation):
     _name = 'GetItemDetails'
 
-    def get_xml(self):
-        return GetItemDetailsRequest(
-                    BuyersID(self._ctx._userid),
-                    self._xml_cred,
-                    SellersItemIdentification(ID(self._code)),
-                )
+    def get_xml(self, code):
+        res = GetItemDetailsRequest()
+        res.extend(self._xml_auth)
+        res.append(SellersItemIdentification(ID(unicode(code))))
+        return res
 
     def execute(self, code):
-        self._code = code
-        return Product(self._ctx.dispatch_request(self))
+        return Product(self._ctx.dispatch_request(self, code))
 
 
 class GetItemDetailsList(Operation):
     _name = 'GetItemDetailsList'
+    _response = '{%s}GetItemDetailsListResponse' % VCO_NAMESPACE
 
-    def get_url_args(self):
+    def get_url_args(self, codes):
         args = [('RequestName', 'GetItemDetailsListRequest')]
-        for code in self._codes:
+        for code in codes:
             args.append(('SellersItemIdentification', code))
         return args
 
-    def get_xml(self):
+    def get_xml(self, codes):
         req = GetItemDetailsListRequest()
         req.extend(self._xml_auth)
-        for code in self._codes:
-            req.append(RequestEntry(SellersItemIdentification(
-                        ID(unicode(code)))))
+        req.extend(RequestEntry(SellersItemIdentification(ID(unicode(code))))
+                   for code in codes)
         return req
 
-    def execute(self, codes):
+    @classmethod
+    def complete(cls, root, codes):
+        # Every requested code is answered with an item detail.
+        details = root.xpath('/vco:GetItemDetailsListResponse/vco:ItemDetail',
+                             namespaces=NAMESPACES)
+        return len(details) >= len(set(codes))
+
+    def observe(self, latency, nbytes, codes):
+        self._ctx.batch_tuner.record(len(codes), latency, nbytes)
+
+    def execute(self, codes, replacements=False):
+        return item_details(self._ctx.dispatch_request(self, codes),
+                            replacements)
+
+    def execute_async(self, codes):
+        # Fetches the response and hands large ones to the process pool.
+        # The returned object provides ready() and get() like AsyncResult,
+        # get() returns ProductRecords whichever way it was parsed.
+        res = self._ctx.fetch(self, codes)
+        if len(res) < self._ctx._pool_threshold:
+            return ParsedResult(self, codes, res)
+        return PoolResult(self, codes, self._ctx._pool.apply_async(
+                parse_item_details,
+                (res, codes, self._ctx._recover, self._ctx._cleaners)))
+
+
+class ParsedResult(object):
+    def __init__(self, op, codes, data):
+        self._op = op
         self._codes = codes
-        root = self._ctx.dispatch_request(self)
-        items = root.xpath(
-                '/vco:GetItemDetailsListResponse/vco:ItemDetail',
-                namespaces=NAMESPACES)
+        self._data = data
 
-        res = []
-        for item in items:
-            product = Product(item)
-            # return only products without replacement
-            if product.replacement is None:
-                res.append(product)
+    def ready(self):
+        return True
 
-        return res
+    def _refetch(self):
+        self._op._ctx.log('Invalid response', 'Will fetch xml again.')
+        self._op._ctx.metrics.incr('responses.refetched')
+        return map(ProductRecord.from_model, self._op.execute(self._codes))
+
+    def get(self):
+        root = self._op._ctx.parse(self._data, self._op, (self._codes,))
+        if root is None:
+            return self._refetch()
+
+        err = response_code(root)
+        if err != ERR_NONE:
+            raise VeloConnectException(err)
+        return map(ProductRecord.from_model, item_details(root))
+
+
+class PoolResult(ParsedResult):
+    def ready(self):
+        return self._data.ready()
+
+    def get(self):
+        err, records = self._data.get()
+        if err is None:
+            return self._refetch()
+        if err != ERR_NONE:
+            raise VeloConnectException(err)
+        return records
 
 
 class CreateTextSearch(Operation):
     _name = 'TextSearch'
 
-    def get_url_args(self):
+    def get_url_args(self, keywords):
         return [('RequestName', 'CreateTextSearchRequest'),
-                ('SearchString', ' '.join(self._keywords).encode('utf8'))]
+                ('SearchString', ' '.join(keywords).encode('utf8'))]
 
-    def get_xml(self):
+    def get_xml(self, keywords):
         res = CreateTextSearchRequest()
         res.extend(self._xml_auth)
-        res.append(SearchString(' '.join(self._keywords)))
+        res.append(SearchString(' '.join(keywords)))
         return res
 
     def execute(self, keywords):
-        self._keywords = keywords
-        return TextSearchResponse(self._ctx.dispatch_request(self))
+        return TextSearchResponse(self._ctx.dispatch_request(self, keywords),
+                                  self._ctx)
 
 
 class SearchResult(Operation):
     _name = 'TextSearch'
 
-    def get_url_args(self):
+    def get_url_args(self, tan, offset, limit):
         return [('RequestName', 'SearchResultRequest'),
-                ('TransactionID', self._tan),
-                ('StartIndex', self._offset),
-                ('Count', self._limit),
+                ('TransactionID', tan),
+                ('StartIndex', offset),
+                ('Count', limit),
                 ('ResultFormat', 'ID_ONLY'),]
 
-    def get_xml(self):
+    def get_xml(self, tan, offset, limit):
         res = SearchResultRequest()
         res.extend(self._xml_auth + [
-                TransactionID(self._tan),
-                StartIndex(unicode(self._offset)),
-                Count(unicode(self._limit)),
+                TransactionID(tan),
+                StartIndex(unicode(offset)),
+                Count(unicode(limit)),
                 ResultFormat('ID_ONLY')])
         return res
 
     def execute(self, tan, offset, limit):
-        self._offset = offset
-        self._limit = limit
-        self._tan = tan
-        root = self._ctx.dispatch_request(self)
+        root = self._ctx.dispatch_request(self, tan, offset, limit)
         # Some implementations differ, so:
         items = root.xpath('//cac:SellersItemIdentification/cac:ID',
                            namespaces=NAMESPACES)
         return [i.text for i in items]
 
 
+def order_request_lines(lines):
+    for code, qty, unit in lines:
+        yield OrderRequestLine(SellersItemIdentification(ID(code)),
+                               Quantity(qty, quantityUnitCode=unit))
+
+
 class CreateOrder(Operation):
     _name = 'Order'
+    _idempotent = False
 
-    def get_url_args(self):
+    def get_url_args(self, lines, istest=False):
         args = [('RequestName', 'CreateOrderRequest')]
-        for line in self._lines:
-            product_id = line.find('cac:SellersItemIdentification/cac:ID',
-                    namespaces=NAMESPACES).text
-            quantity = line.find('cbc:Quantity', namespaces=NAMESPACES)
+        if istest:
+            args.append(('IsTest', True))
+        for code, qty, unit in lines:
             args += [
-                ('Quantity.' + product_id, quantity.text),
-                ('quantityUnitCode.' + product_id, quantity.get('quantityUnitCode'))
+                ('Quantity.' + code, qty),
+                ('quantityUnitCode.' + code, unit)
             ]
         return args
 
-    def get_xml(self):
+    def get_xml(self, lines, istest=False):
         res = CreateOrderRequest()
         res.extend(self._xml_auth)
-        res.append(self._xml_istest)
-        res.extend(self._lines)
+        res.append(XML_ISTEST if istest else self._xml_istest)
+        res.extend(order_request_lines(lines))
         return res
 
-    def execute(self, lines):
-        self._lines = lines
-        return Order(self._ctx.dispatch_request(self), self._ctx)
+    def execute(self, lines, istest=False):
+        # With istest the order is created in test mode regardless of the
+        # context's setting.
+        return Order(self._ctx.dispatch_request(self, lines, istest),
+                     self._ctx)
 
 
 class UpdateOrder(Operation):
     _name = 'Order'
+    _idempotent = False
 
-    def get_xml(self):
+    def get_xml(self, tan, lines):
         res = UpdateOrderRequest()
         res.extend(self._xml_auth)
-        res.append(TransactionID(self._tan))
+        res.append(TransactionID(tan))
         res.append(self._xml_istest)
-        res.extend(self._lines)
+        res.extend(order_request_lines(lines))
         return res
 
     def execute(self, tan, lines):
-        self._lines = lines
-        self._tan = tan
-        return self._ctx.dispatch_request(self)
+        return self._ctx.dispatch_request(self, tan, lines)
 
 
 class ViewOrder(Operation):
     _name = 'Order'
+    _response = '{%s}OrderResponse' % VCO_NAMESPACE
 
-    def get_xml(self):
+    def get_xml(self, tan):
         res = ViewOrderRequest()
         res.extend(self._xml_auth)
-        res.append(TransactionID(self._tan))
+        res.append(TransactionID(tan))
         res.append(self._xml_istest)
         return res
 
     def execute(self, tan):
-        self._tan = tan
-        return self._ctx.dispatch_request(self)
+        return self._ctx.dispatch_request(self, tan)
 
 
 class FinishOrder(Operation):
     _name = 'Order'
+    _idempotent = False
 
-    def get_url_args(self):
+    def get_url_args(self, tan):
         return [('RequestName', 'FinishOrderRequest'),
-                ('TransactionID', self._tan),]
+                ('TransactionID', tan),]
 
-    def get_xml(self):
+    def get_xml(self, tan):
         res = FinishOrderRequest()
         res.extend(self._xml_auth)
-        res.append(TransactionID(self._tan))
+        res.append(TransactionID(tan))
         res.append(self._xml_istest)
         return res
 
     def execute(self, tan):
-        self._tan = tan
-        return self._ctx.dispatch_request(self)
+        return self._ctx.dispatch_request(self, tan)
+
+
+#
+# Transaction management
+#
+class _Slots(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+        # The transaction managers sharing the slots.
+        self.managers = weakref.WeakSet()
+
+
+_supplier_slots = {}
+_supplier_slots_lock = threading.Lock()
+
+
+def supplier_slots(url, userid, limit):
+    # Transaction slots are shared by all contexts of a supplier login.
+    key = (url, userid)
+    with _supplier_slots_lock:
+        if key not in _supplier_slots:
+            _supplier_slots[key] = _Slots(limit)
+        return _supplier_slots[key]
+
+
+_managers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_managers():
+    for manager in list(_managers):
+        try:
+            manager.close()
+        except Exception:
+            pass
+
+
+def search_key(keywords):
+    # Text searches don't depend on the case or order of the words.
+    return tuple(sorted(set(searchcache.normalize(keywords))))
+
+
+class Transaction(object):
+    def __init__(self, tan, purpose, key=None):
+        self.tan = tan
+        self.purpose = purpose
+        self.key = key
+        self.created = time.time()
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+
+class TransactionManager(object):
+    # Tracks the open transactions of a context and limits their number per
+    # supplier login. Callers wait up to timeout seconds for a free slot
+    # instead of running into ERR_CANT_CREATE_TRANSACTION. To get a slot,
+    # cached searches and transactions older than max_age are rolled back,
+    # whichever context of the login opened them. Search transactions are
+    # reused for the same keywords for search_ttl seconds and rolled back
+    # after that.
+    SEARCH_TTL = 300
+    MAX_AGE = 3600
+    ACQUIRE_TIMEOUT = 60
+
+    def __init__(self, context, limit=MAX_TRANSACTIONS,
+                 search_ttl=SEARCH_TTL, max_age=MAX_AGE,
+                 timeout=ACQUIRE_TIMEOUT):
+        self._ctx = context
+        self._slots = supplier_slots(context._url, context._userid, limit)
+        self._search_ttl = search_ttl
+        self._max_age = max_age
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._open = {}
+        self._searches = {}
+        self._slots.managers.add(self)
+        _managers.add(self)
+
+    def transactions(self):
+        with self._lock:
+            return self._open.values()
+
+    def _expired(self):
+        # Forgets the cached searches older than search_ttl.
+        with self._lock:
+            res = [t for t in self._open.itervalues()
+                   if t.key is not None and t.age >= self._search_ttl]
+            for trans in res:
+                self._forget(trans.tan)
+        return res
+
+    def _expire(self):
+        for manager in list(self._slots.managers):
+            for trans in manager._expired():
+                try:
+                    manager._rollback(trans.tan)
+                finally:
+                    self._release()
+
+    def _candidates(self):
+        with self._lock:
+            return ([t for t in self._open.itervalues() if t.key is not None],
+                    [t for t in self._open.itervalues()
+                     if t.age > self._max_age])
+
+    def _victim(self):
+        # The oldest cached search of the managers sharing the slots,
+        # otherwise the oldest abandoned transaction. Returns the manager
+        # and the transaction, which is already forgotten.
+        searches, abandoned = [], []
+        for manager in list(self._slots.managers):
+            s, a = manager._candidates()
+            searches += [(t, manager) for t in s]
+            abandoned += [(t, manager) for t in a]
+        for trans, manager in sorted(searches or abandoned,
+                                     key=lambda c: c[0].created):
+            with manager._lock:
+                # Unless it was closed meanwhile.
+                if manager._forget(trans.tan) is not None:
+                    return manager, trans
+        return None
+
+    def _acquire(self):
+        self._expire()
+        slots = self._slots
+        deadline = time.time() + self._timeout
+        while True:
+            with slots.cond:
+                if slots.used < slots.limit:
+                    slots.used += 1
+                    return
+                victim = self._victim()
+                if victim is None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise VeloConnectException(
+                            ERR_CANT_CREATE_TRANSACTION)
+                    slots.cond.wait(min(remaining, 1.0))
+                    continue
+            manager, trans = victim
+            try:
+                manager._rollback(trans.tan)
+            finally:
+                self._release()
+
+    def _release(self):
+        with self._slots.cond:
+            self._slots.used -= 1
+            self._slots.cond.notify()
+
+    def _forget(self, tan):
+        trans = self._open.pop(tan, None)
+        if trans is not None and trans.key is not None:
+            self._searches.pop(trans.key, None)
+        return trans
+
+    def _track(self, tan, purpose, key=None):
+        trans = Transaction(tan, purpose, key)
+        with self._lock:
+            self._open[tan] = trans
+        return trans
+
+    def _open_transaction(self, purpose, func, *args):
+        self._acquire()
+        try:
+            res = func(*args)
+        except:
+            self._release()
+            raise
+        self._track(res.tan, purpose)
+        return res
+
+    def _rollback(self, tan):
+        try:
+            Rollback(self._ctx).execute(tan)
+        except VeloConnectException, e:
+            if e.code not in (ERR_NOT_SUPPORTED, ERR_UNKNOWN_TRANSACTION_ID):
+                raise
+
+    def release(self, tan):
+        # The transaction was closed, e.g. by finishing the order.
+        with self._lock:
+            trans = self._forget(tan)
+        if trans is not None:
+            self._release()
+
+    def rollback(self, tan):
+        with self._lock:
+            trans = self._forget(tan)
+        try:
+            self._rollback(tan)
+        finally:
+            if trans is not None:
+                self._release()
+
+    def search(self, keywords):
+        key = search_key(keywords)
+        with self._lock:
+            tan = self._searches.get(key)
+            trans = self._open.get(tan)
+            if trans is not None and trans.age < self._search_ttl:
+                return trans.response
+        if trans is not None:
+            self.rollback(trans.tan)
+
+        self._acquire()
+        try:
+            res = CreateTextSearch(self._ctx).execute(keywords)
+        except:
+            self._release()
+            raise
+        with self._lock:
+            trans = Transaction(res.tan, 'search', key)
+            trans.response = res
+            old = self._searches.get(key)
+            self._open[res.tan] = trans
+            self._searches[key] = res.tan
+        if old is not None:
+            # Another thread searched the same keywords meanwhile.
+            self.rollback(old)
+        return res
+
+    def probe(self):
+        # An uncached search, rolled back right away. It doesn't take a
+        # slot, so probes don't queue behind open orders. A supplier
+        # refusing further transactions is up.
+        try:
+            res = CreateTextSearch(self._ctx).execute(['NOTHING'])
+        except VeloConnectException, e:
+            if e.code == ERR_CANT_CREATE_TRANSACTION:
+                return
+            raise
+        self._rollback(res.tan)
+
+    def invalidate(self, keywords):
+        with self._lock:
+            tan = self._searches.get(search_key(keywords))
+        if tan is not None:
+            self.rollback(tan)
+
+    def create_order(self, lines, istest=False):
+        return self._open_transaction('order', CreateOrder(self._ctx).execute,
+                                      lines, istest)
+
+    @contextlib.contextmanager
+    def order(self, lines, istest=False):
+        # The order is rolled back on exit unless it was finished.
+        order = self.create_order(lines, istest)
+        try:
+            yield order
+        finally:
+            if order.tan in self._open:
+                order.rollback()
+
+    def close(self):
+        with self._lock:
+            tans = self._open.keys()
+        for tan in tans:
+            self.rollback(tan)
 
 
 #
@@ -475,12 +1140,7 @@ class TransactionMixin(object):
     tan = base.String('vct:TransactionID')
 
     def rollback(self):
-        try:
-            rbk = Rollback(self._ctx)
-            rbk.execute(self.tan)
-        except VeloConnectException, e:
-            if e.code != ERR_NOT_SUPPORTED:
-                raise
+        self._ctx.transactions.rollback(self.tan)
 
 
 class TextSearchResponse(VeloModelMixin, TransactionMixin, Model):
@@ -488,6 +1148,7 @@ class TextSearchResponse(VeloModelMixin, TransactionMixin, Model):
 
 
 class Product(VeloModelMixin, ProductBase):
+    MAX_REPLACEMENT_HOPS = 10
     _name_exp = re.compile(r'[\n\r]|&nbsp;')
     _prefixes = ['cac:Item/']   # 'Works with ItemDetail and Item nodes.'
 
@@ -527,7 +1188,8 @@ class Product(VeloModelMixin, ProductBase):
 
     @property
     def sellers_item_identification(self):
-        return SellersItemIdentification(ID(self.code))
+        cac = ElementMaker(namespace=CAC_NAMESPACE)
+        return cac.SellersItemIdentification(cac.ID(self.code))
 
     @property
     def picture(self):
@@ -541,9 +1203,22 @@ class Product(VeloModelMixin, ProductBase):
         return buffer(urllib2.urlopen(url).read())
 
     @classmethod
-    def search(cls, keywords, offset=0, limit=20, count=False):
-        cts = CreateTextSearch(cls._ctx)
-        ctsresp = cts.execute(keywords)
+    def _search_result(cls, keywords, offset, limit):
+        ctsresp = cls._ctx.transactions.search(keywords)
+        sr = SearchResult(cls._ctx)
+        try:
+            return sr.execute(ctsresp.tan, offset, limit)
+        except VeloConnectException, e:
+            # The reused transaction is gone, start a new one.
+            if e.code != ERR_UNKNOWN_TRANSACTION_ID:
+                raise
+            cls._ctx.transactions.invalidate(keywords)
+            ctsresp = cls._ctx.transactions.search(keywords)
+            return sr.execute(ctsresp.tan, offset, limit)
+
+    @classmethod
+    def _search(cls, keywords, offset=0, limit=20, count=False):
+        ctsresp = cls._ctx.transactions.search(keywords)
 
         if count:
             return ctsresp.count
@@ -551,16 +1226,125 @@ class Product(VeloModelMixin, ProductBase):
         if ctsresp.count == 0:
             return []
 
-        sr = SearchResult(cls._ctx)
-        return sr.execute(ctsresp.tan, offset, limit)
+        return cls._search_result(keywords, offset, limit)
+
+    @classmethod
+    def iter_search(cls, keywords, offset=0, page_size=100, fresh=False):
+        if fresh:
+            cls._ctx.transactions.invalidate(keywords)
+        total = cls._ctx.transactions.search(keywords).count
+        while offset < total:
+            codes = cls._search_result(keywords, offset, page_size)
+            if not codes:
+                break
+            for code in codes:
+                yield code
+            offset += len(codes)
+
+    @classmethod
+    def search_products(cls, keywords, offset=0, limit=None, page_size=100,
+                        concurrency=4):
+        # Every page of codes is read in the thread pool as soon as it
+        # arrives, while the next page is requested. The products are
+        # yielded in search order.
+        page_size = page_size or cls._ctx.batch_tuner.size()
+        if limit is not None:
+            page_size = min(page_size, limit)
+        codes = cls.iter_search(keywords, offset, page_size)
+        if limit is not None:
+            codes = itertools.islice(codes, limit)
+
+        read = scheduler.bound(cls.read)
+        pool = ThreadPool(concurrency)
+        pending = collections.deque()
+        try:
+            for batch in base.chunks(codes, page_size):
+                pending.append(pool.apply_async(read, (batch,)))
+                while pending and (pending[0].ready()
+                                   or len(pending) > concurrency):
+                    for product in pending.popleft().get():
+                        yield product
+
+            while pending:
+                for product in pending.popleft().get():
+                    yield product
+        finally:
+            pool.terminate()
+
+    @classmethod
+    def read(cls, codes, resolve_replacements=False):
+        # With resolve_replacements a tuple (products, replacements) is
+        # returned, where replacements maps every requested code to its
+        # final product, following replacement chains.
+        gidl = GetItemDetailsList(cls._ctx)
+        if not resolve_replacements:
+            return cls._indexed(gidl.execute(codes))
+
+        products = cls._indexed(gidl.execute(codes, replacements=True))
+        return ([p for p in products if p.replacement is None],
+                cls._resolve_replacements(codes, products))
 
     @classmethod
-    def read(cls, codes):
+    def _resolve_replacements(cls, codes, products):
+        # All replacements of one hop are read in one request. Codes
+        # running into a cycle, unknown codes and chains longer than
+        # MAX_REPLACEMENT_HOPS are mapped to None.
+        res = {}
+        current = dict((code, code) for code in codes)
+        visited = dict((code, set([code])) for code in codes)
         gidl = GetItemDetailsList(cls._ctx)
-        return gidl.execute(codes)
+        for hop in range(cls.MAX_REPLACEMENT_HOPS + 1):
+            by_code = dict((p.code, p) for p in products)
+            pending = set()
+            for code, cur in current.items():
+                product = by_code.get(cur)
+                if product is not None and product.replacement is not None \
+                        and product.replacement not in visited[code] \
+                        and hop < cls.MAX_REPLACEMENT_HOPS:
+                    current[code] = product.replacement
+                    visited[code].add(product.replacement)
+                    pending.add(product.replacement)
+                    continue
+
+                if product is None or not product.valid \
+                        or product.replacement is not None:
+                    product = None
+                res[code] = product
+                del current[code]
+
+            if not pending:
+                break
+            products = gidl.execute(list(pending), replacements=True)
+
+        return res
+
+    @classmethod
+    def iter_read(cls, codes, batch_size=None):
+        # With a process pool the next batches are fetched while the
+        # previous responses are parsed, and serialize.ProductRecord
+        # objects are yielded instead of products.
+        batch_size = cls._batch_size(batch_size)
+        if cls._ctx._pool is None:
+            for batch in base.chunks(codes, batch_size):
+                for product in cls.read(batch):
+                    yield product
+            return
 
+        pending = collections.deque()
+        for batch in base.chunks(codes, batch_size):
+            gidl = GetItemDetailsList(cls._ctx)
+            pending.append(gidl.execute_async(batch))
+            while pending and (pending[0].ready()
+                    or len(pending) >= cls._ctx.MAX_PENDING_PARSES):
+                for product in cls._indexed(pending.popleft().get()):
+                    yield product
 
-class Line(VeloModelMixin, Model):
+        while pending:
+            for product in cls._indexed(pending.popleft().get()):
+                yield product
+
+
+class Line(VeloModelMixin, LineBase):
     quantity = base.Decimal('cbc:Quantity')
     unit_price = base.Decimal('cac:UnitPrice')
     product = base.Many2One('cac:Item', model=Product)
@@ -569,33 +1353,60 @@ class Line(VeloModelMixin, Model):
 
 
 class Order(VeloModelMixin, TransactionMixin, OrderBase):
-    lines = base.One2Many('/vco:OrderResponse/vco:OrderResponseLine',
-        model=Line)
+    # Lines per CreateOrder or UpdateOrder request
+    CHUNK_SIZE = 500
+    _line_tag = '{%s}OrderResponseLine' % VCO_NAMESPACE
+
     orderid = base.String('vco:OrderHeader/vco:OrderID')
 
     def _load(self, tan):
         vo = ViewOrder(self._ctx)
         self._data = vo.execute(tan)
 
+    def iter_lines(self):
+        # Streams the lines of the response, nothing is kept.
+        for node in self._data.iterchildren(self._line_tag):
+            yield Line(node)
+
     @staticmethod
     def _build_lines(lines):
-        rlines = []
-        for product, qty in lines:
-            line = OrderRequestLine(product.sellers_item_identification,
-                    Quantity(str(qty), quantityUnitCode=product.unit_code))
-            rlines.append(line)
-        return rlines
+        return [(unicode(code), str(qty), unit)
+                for code, qty, unit in base.order_lines(lines)]
 
-    def add_lines(self, lines):
+    def _update(self, lines):
         uo = UpdateOrder(self._ctx)
-        self._data = uo.execute(self.tan, self._build_lines(lines))
+        for chunk in base.chunks(lines, self.CHUNK_SIZE):
+            self._data = uo.execute(self.tan, chunk)
+
+    def add_lines(self, lines):
+        self._update(self._build_lines(lines))
 
     def finish(self):
+        tan = self.tan
         fo = FinishOrder(self._ctx)
-        self._data = fo.execute(self.tan)
+        self._data = fo.execute(tan)
+        self._ctx.transactions.release(tan)
         return self
 
     @classmethod
     def create(cls, lines):
-        co = CreateOrder(cls._ctx)
-        return co.execute(cls._build_lines(lines))
+        # Large orders are created with the first CHUNK_SIZE lines, the
+        # others are added by UpdateOrder requests if supported.
+        lines = cls._build_lines(lines)
+        if len(lines) <= cls.CHUNK_SIZE or not cls._ctx.supports(UpdateOrder):
+            return cls._ctx.transactions.create_order(lines)
+
+        order = cls._ctx.transactions.create_order(lines[:cls.CHUNK_SIZE])
+        try:
+            order._update(lines[cls.CHUNK_SIZE:])
+        except:
+            order.rollback()
+            raise
+        return order
+
+    @classmethod
+    def _check_chunk(cls, lines):
+        # The test order is always rolled back.
+        with cls._ctx.transactions.order(cls._build_lines(lines),
+                                         istest=True) as order:
+            return list(order.iter_lines())
@@ -0,0 +1,180 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Background watcher for product availability.
+#
+# Watched codes are read in batches per context whenever they are due and
+# compared with the previous snapshot. Subscribers are called as
+# callback(context, code, old, new) with (availability, available_quantity)
+# tuples, only for codes whose availability changed. Codes that changed
+# recently or are low on stock are polled with the shorter hot interval.
+
+import threading
+import time
+
+from . import scheduler
+from .base import chunks
+
+# Snapshot of codes which have not been read yet.
+_UNREAD = object()
+
+
+class AvailabilityWatcher(object):
+    def __init__(self, interval=600, hot_interval=60, hot_period=3600,
+                 low_stock=5, batch_size=None):
+        self.interval = interval
+        self.hot_interval = hot_interval
+        self.hot_period = hot_period
+        self.low_stock = low_stock
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._subscribers = []
+        # context -> {code: [due, snapshot, last change]}
+        self._watched = {}
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def watch(self, context, codes):
+        with self._lock:
+            watched = self._watched.setdefault(context, {})
+            for code in codes:
+                # Due immediately, the first read only takes the snapshot.
+                watched.setdefault(code, [0, _UNREAD, None])
+
+    def unwatch(self, context, codes):
+        with self._lock:
+            watched = self._watched.get(context, {})
+            for code in codes:
+                watched.pop(code, None)
+            if not watched:
+                self._watched.pop(context, None)
+
+    def _next_interval(self, state, now):
+        snapshot, changed = state[1], state[2]
+        if changed is not None and now - changed < self.hot_period:
+            return self.hot_interval
+        if isinstance(snapshot, tuple) and snapshot[1] is not None \
+                and snapshot[1] <= self.low_stock:
+            return self.hot_interval
+        return self.interval
+
+    def _retry(self, context, codes, now):
+        with self._lock:
+            watched = self._watched.get(context, {})
+            for code in codes:
+                state = watched.get(code)
+                if state is not None:
+                    state[0] = now + self.hot_interval
+
+    def _notify(self, context, code, old, new):
+        for callback in list(self._subscribers):
+            callback(context, code, old, new)
+
+    def poll(self, now=None):
+        # Reads all due codes once and returns the number of codes read.
+        with scheduler.priority(scheduler.BULK):
+            return self._poll(now)
+
+    def _poll(self, now):
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            due = [(ctx, [code for code, state in watched.iteritems()
+                          if state[0] <= now])
+                   for ctx, watched in self._watched.items()]
+
+        nread = 0
+        for ctx, codes in due:
+            Product = ctx.get('Product')
+            batch_size = self.batch_size or ctx.batch_tuner.size
+            for batch in chunks(codes, batch_size):
+                products = {}
+                try:
+                    for product in Product.read(batch):
+                        products[product.code] = (
+                            getattr(product, 'availability', None),
+                            getattr(product, 'available_quantity', None))
+                except Exception:
+                    # Retry soon, the other contexts are still polled.
+                    ctx.metrics.incr('watch.errors')
+                    self._retry(ctx, batch, now)
+                    continue
+                nread += len(batch)
+
+                with self._lock:
+                    watched = self._watched.get(ctx, {})
+                    changes = []
+                    for code in batch:
+                        state = watched.get(code)
+                        if state is None:
+                            continue
+                        new = products.get(code)
+                        old = state[1]
+                        if old is not _UNREAD and old != new:
+                            state[2] = now
+                            changes.append((code, old, new))
+                        state[1] = new
+                        state[0] = now + self._next_interval(state, now)
+
+                for code, old, new in changes:
+                    self._notify(ctx, code, old, new)
+
+        return nread
+
+    def next_due(self):
+        with self._lock:
+            return min([state[0] for watched in self._watched.itervalues()
+                        for state in watched.itervalues()] or [None])
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+                due = self.next_due()
+            except Exception:
+                # Keep watching, the supplier may be back on the next round.
+                due = None
+            timeout = self.hot_interval if due is None \
+                else max(due - time.time(), 0.1)
+            self._stop.wait(timeout)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -21,14 +21,19 @@
 # THE SOFTWARE.
 
 import copy
+import time
 import urllib2
+import uuid
 from lxml import etree
 import urllib
 
-from .base import ProductBase, ContextBase, OrderBase, EDIException, Model
+from .base import (ProductBase, ContextBase, OrderBase, LineBase, EDIException,
+                   TRANSPORT_ERRORS)
 import base
 
 BASKETNAME = 'warenkorb'
+# Lines per basket request, they are sent in the URL.
+BASKET_CHUNK_SIZE = 100
 
 class WinoraException(EDIException):
     def __init__(self, msg):
@@ -48,14 +53,21 @@ class InvalidProduct(ProductBase):
 class Context(ContextBase):
     def get(self, clsname):
         if clsname == 'Product':
-            return Product.copy(self)
+            return self._bind(Product)
         elif clsname == 'Order':
-            return Order.copy(self)
+            return self._bind(Order)
         return None
 
-    def dispatch_request(self, request):
-        args = request.get_url_args()
-        root = etree.fromstring(self.execute(args))
+    def dispatch_request(self, request, *args):
+        params = request.get_url_args(*args)
+        start = time.time()
+        try:
+            data = self.execute(params)
+        except TRANSPORT_ERRORS:
+            request.observe(None, None, *args)
+            raise
+        request.observe(time.time() - start, len(data), *args)
+        root = etree.fromstring(data)
         self.log('XML Response', etree.tostring(root, pretty_print=True))
         msg, = root.xpath('/root/processmessage')
         if msg.text != 'ok':
@@ -63,25 +75,26 @@ class Context(ContextBase):
         return root
 
     def execute(self, params):
+        self.check_breaker()
         params = [('loginid', self._userid),
                    ('password', self._passwd)] + params
         self.log('Args', str(params))
         url = '%s?%s' % (self._url, urllib.urlencode(params))
-        return urllib2.urlopen(url).read()
+        with self.scheduler.slot(self):
+            return urllib2.urlopen(url).read()
 
-    def check(self):
-        vi = VersionInfo(self)
-        try:
-            etree.tostring(vi.execute(), pretty_print=True)
-        except:
-            return False
-        return True
+    def probe(self):
+        VersionInfo(self).execute()
 
 
 class WinoraBase(object):
     def __init__(self, context):
         self._ctx = context
 
+    def observe(self, latency, nbytes, *args):
+        # Called after every response, latency is None on errors.
+        pass
+
 
 class VersionInfo(WinoraBase):
     def get_url_args(self):
@@ -92,59 +105,60 @@ class VersionInfo(WinoraBase):
 
 
 class ItemDetails(WinoraBase):
-    def get_url_args(self):
+    def get_url_args(self, codes):
         return [('processtype', 'itemdetails'),
-                ('pagesize', 100)] + [('itemnumber', c) for c in self._codes]
+                ('pagesize', max(len(codes), 100))] + [
+                    ('itemnumber', c) for c in codes]
+
+    def observe(self, latency, nbytes, codes):
+        self._ctx.batch_tuner.record(len(codes), latency, nbytes)
 
     def execute(self, codes):
-        self._codes = codes
-        root = self._ctx.dispatch_request(self)
+        root = self._ctx.dispatch_request(self, codes)
         items = root.xpath('/root/item')
         return map(Product, items)
 
 
 class SearchProducts(WinoraBase):
-    def get_url_args(self):
+    def get_url_args(self, keywords, page, limit):
         return [('processtype', 'searchcatalog'),
-                ('pagesize', self._limit),
-                ('page', self._page),
-                ('searchpattern', ' '.join(self._keywords).encode('utf-8') )]
+                ('pagesize', limit),
+                ('page', page),
+                ('searchpattern', ' '.join(keywords).encode('utf-8') )]
 
     def execute(self, keywords, offset, limit):
-        self._keywords = keywords
-        self._limit = limit
-        self._page = int(offset / limit)
-        root = self._ctx.dispatch_request(self)
+        root = self._ctx.dispatch_request(
+            self, keywords, int(offset / limit), limit)
         items = root.xpath('/root/item')
         return map(Product, items)
 
 
 class DeleteBasket(WinoraBase):
-    def get_url_args(self):
-        return [('processtype', 'delbasket'), ('basketname', BASKETNAME)]
+    def get_url_args(self, basketname):
+        return [('processtype', 'delbasket'), ('basketname', basketname)]
 
-    def execute(self):
-        return self._ctx.dispatch_request(self)
+    def execute(self, basketname=BASKETNAME):
+        return self._ctx.dispatch_request(self, basketname)
 
 
 class Basket(WinoraBase):
-    def get_url_args(self):
-        res = [('processtype', 'basket'), ('basketname', BASKETNAME)]
-        for line in self._lines:
-            res.append(('itemquantity.' + line[0].code, int(line[1])))
+    def get_url_args(self, lines, basketname):
+        res = [('processtype', 'basket'), ('basketname', basketname)]
+        for code, qty, unit in lines:
+            res.append(('itemquantity.' + code, int(qty)))
         return res
 
-    def execute(self, lines):
-        self._lines = lines
-        self._ctx.dispatch_request(self)
+    def execute(self, lines, basketname=BASKETNAME):
+        for chunk in base.chunks(base.order_lines(lines), BASKET_CHUNK_SIZE):
+            self._ctx.dispatch_request(self, chunk, basketname)
 
 
 class ViewBasket(WinoraBase):
-    def get_url_args(self):
-        return [('processtype', 'viewbasket'), ('basketname', BASKETNAME)]
+    def get_url_args(self, basketname):
+        return [('processtype', 'viewbasket'), ('basketname', basketname)]
 
-    def execute(self):
-        return self._ctx.dispatch_request(self)
+    def execute(self, basketname=BASKETNAME):
+        return self._ctx.dispatch_request(self, basketname)
 
 
 class OrderBasket(WinoraBase):
@@ -178,7 +192,7 @@ class Product(ProductBase):
         return descr
 
     @classmethod
-    def search(cls, keywords, offset=0, limit=20, count=False):
+    def _search(cls, keywords, offset=0, limit=20, count=False):
         if limit is None:
             limit = 20
 
@@ -193,6 +207,33 @@ class Product(ProductBase):
 
         return [p.code for p in products]
 
+    @classmethod
+    def iter_search(cls, keywords, offset=0, page_size=100, fresh=False):
+        for product in cls.search_products(keywords, offset,
+                                           page_size=page_size):
+            yield product.code
+
+    @classmethod
+    def search_products(cls, keywords, offset=0, limit=None, page_size=100,
+                        concurrency=4):
+        # searchcatalog already returns full items, no need to read them.
+        page_size = page_size or cls._ctx.batch_tuner.size()
+        skip = offset % page_size
+        offset -= skip
+        while limit is None or limit > 0:
+            sp = SearchProducts(cls._ctx)
+            products = cls._indexed(sp.execute(keywords, offset, page_size))
+            page = products[skip:]
+            if limit is not None:
+                page = page[:limit]
+                limit -= len(page)
+            for product in page:
+                yield product
+            if len(products) < page_size:
+                break
+            offset += page_size
+            skip = 0
+
     @classmethod
     def read(cls, codes):
         if len(codes) == 0:
@@ -212,10 +253,10 @@ class Product(ProductBase):
             else:
                 res.append(InvalidProduct(code))
 
-        return res
+        return cls._indexed(res)
 
 
-class Line(Model):
+class Line(LineBase):
     product = base.Many2One(model=Product)
     quantity = base.Decimal('quantity')
     available_quantity = base.Decimal('availablequantity')
@@ -231,12 +272,27 @@ class Line(Model):
 
 
 class Order(OrderBase):
-    lines = base.One2Many('/root/item', model=Line)
+    def iter_lines(self):
+        # Streams the lines of the basket, nothing is kept.
+        for node in self._data.iterchildren('item'):
+            yield Line(node)
 
     @classmethod
     def create(cls, lines):
         return Order(lines, context=cls._ctx)
 
+    @classmethod
+    def _check_chunk(cls, lines):
+        # The lines are put into their own basket, which is deleted
+        # afterwards.
+        basketname = 'check-' + uuid.uuid4().hex[:12]
+        try:
+            Basket(cls._ctx).execute(lines, basketname)
+            root = ViewBasket(cls._ctx).execute(basketname)
+            return map(Line, root.iterchildren('item'))
+        finally:
+            DeleteBasket(cls._ctx).execute(basketname)
+
     def __init__(self, lines, context):
         self._lines = lines
         self._ctx = context
@@ -252,7 +308,7 @@ class Order(OrderBase):
         self._data = vb.execute()
 
     def add_lines(self, lines):
-        cls._lines += lines
+        self._lines = list(self._lines) + list(lines)
         self._synch()
 
     @property
@@ -33,8 +33,16 @@ Features:
     version=get_version(),
     packages=find_packages(exclude=['examples']),
     install_requires=[
-        "lxml >= 2.0"
+        "lxml >= 3.1"
     ],
+    extras_require={
+        'columnar': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': [
+            'pyveloedi = pyveloedi.cli:main',
+        ],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
@@ -0,0 +1,94 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Max Holtzberg <mh@uvc.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Run with: python -m unittest discover -s tests
+
+import threading
+import time
+import unittest
+
+from pyveloedi import health
+from pyveloedi.metrics import Metrics
+
+
+class FakeContext(object):
+    # Probes take delay seconds, or block until hang is set.
+    def __init__(self, delay=0, hang=None):
+        self.delay = delay
+        self.hang = hang
+        self.metrics = Metrics()
+        self.breaker = None
+        self.health = None
+
+    def probe(self):
+        if self.hang is not None:
+            self.hang.wait()
+        time.sleep(self.delay)
+
+
+class HealthMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.hang = threading.Event()
+        self.monitor = health.HealthMonitor(timeout=0.5, threshold=2)
+
+    def tearDown(self):
+        self.hang.set()
+        self.monitor.stop()
+
+    def register(self, contexts):
+        for context in contexts:
+            self.monitor.register(context)
+        return contexts
+
+    def test_slow_probes_run_concurrently(self):
+        contexts = self.register([FakeContext(0.3) for _ in range(12)])
+        for _ in range(3):
+            self.monitor.probe_all()
+        for context in contexts:
+            self.assertTrue(self.monitor.status(context).ok)
+            self.assertEqual(context.breaker.state, health.CLOSED)
+
+    def test_hung_probes_dont_fail_healthy_contexts(self):
+        hung = self.register([FakeContext(hang=self.hang) for _ in range(10)])
+        healthy = self.register([FakeContext(0.1) for _ in range(4)])
+        for _ in range(4):
+            self.monitor.probe_all()
+        for context in healthy:
+            self.assertTrue(self.monitor.status(context).ok)
+            self.assertEqual(context.breaker.state, health.CLOSED)
+        for context in hung:
+            self.assertEqual(self.monitor.status(context).error, 'timeout')
+            self.assertEqual(context.breaker.state, health.OPEN)
+
+    def test_recovers_after_hang(self):
+        context, = self.register([FakeContext(hang=self.hang)])
+        self.monitor.probe_all()
+        self.assertFalse(self.monitor.status(context).ok)
+        self.hang.set()
+        time.sleep(0.05)
+        self.monitor.probe_all()
+        self.assertTrue(self.monitor.status(context).ok)
+        self.assertEqual(context.breaker.state, health.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()